@@ -0,0 +1,142 @@
+import asyncio
+import collections
+import math
+
+PRIORITIES = {
+    "low": 0,
+    "normal": 1,
+    "high": 2,
+}
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Too many requests are waiting, retry after {} seconds".format(retry_after))
+        self.retry_after = retry_after
+
+class Waiter:
+    __slots__ = ("key", "future")
+
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future
+
+class AdmissionController:
+    """
+    Limits how many requests run at once, overall and per key (endpoint), and decides who runs next
+    when a slot frees up. Higher priorities always go first. Within a priority, clients take turns,
+    so one client submitting a burst doesn't hold everyone else up.
+    A limit of 0 means no limit.
+    """
+    def __init__(self, max_concurrent, max_per_key, max_waiting, key_limits={}):
+        self.max_concurrent = max_concurrent
+        self.max_per_key = max_per_key
+        self.max_waiting = max_waiting
+        self.key_limits = key_limits
+        self.running = 0
+        self.running_by_key = collections.Counter()
+        # priority -> client -> waiters, with clients in the order they get their next turn
+        self.waiting = {}
+        self.waiting_count = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Moving average of how long a request holds its slot, for Retry-After
+        self.average_hold = 1.0
+
+    def limit_for(self, key):
+        return self.key_limits.get(key, self.max_per_key)
+
+    def has_room(self, key):
+        if self.max_concurrent > 0 and self.running >= self.max_concurrent:
+            return False
+        limit = self.limit_for(key)
+        return limit <= 0 or self.running_by_key[key] < limit
+
+    def retry_after(self):
+        slots = self.max_concurrent if self.max_concurrent > 0 else 1
+        return max(1, math.ceil(self.average_hold * (self.waiting_count + 1) / slots))
+
+    async def acquire(self, key, priority=PRIORITIES["normal"], client=None, timeout=None):
+        """
+        Waits for a slot. Raises AdmissionRejected if the wait queue is full, or asyncio.TimeoutError
+        if no slot became available within timeout seconds.
+        """
+        if self.waiting_count == 0 and self.has_room(key):
+            self.grant(key)
+            return asyncio.get_running_loop().time()
+        if self.max_waiting > 0 and self.waiting_count >= self.max_waiting and not self.has_room(key):
+            self.rejected += 1
+            raise AdmissionRejected(self.retry_after())
+
+        waiter = Waiter(key, asyncio.get_running_loop().create_future())
+        clients = self.waiting.setdefault(priority, collections.OrderedDict())
+        clients.setdefault(client, collections.deque()).append(waiter)
+        self.waiting_count += 1
+        # Others may be waiting on a busy endpoint while this one has room
+        self.wake()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just as the wait ended, so the slot has to be handed back
+                self.release(key, asyncio.get_running_loop().time())
+            else:
+                waiter.future.cancel()
+                self.remove(priority, client, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+            raise
+        return asyncio.get_running_loop().time()
+
+    def remove(self, priority, client, waiter):
+        clients = self.waiting[priority]
+        waiters = clients[client]
+        waiters.remove(waiter)
+        self.waiting_count -= 1
+        if len(waiters) == 0:
+            del clients[client]
+            if len(clients) == 0:
+                del self.waiting[priority]
+
+    def grant(self, key):
+        self.running += 1
+        self.running_by_key[key] += 1
+
+    def release(self, key, acquired_at):
+        self.running -= 1
+        self.running_by_key[key] -= 1
+        if self.running_by_key[key] == 0:
+            del self.running_by_key[key]
+        held = asyncio.get_running_loop().time() - acquired_at
+        self.average_hold = 0.8 * self.average_hold + 0.2 * held
+        self.wake()
+
+    def next_waiter(self):
+        for priority in sorted(self.waiting, reverse=True):
+            clients = self.waiting[priority]
+            for client, waiters in clients.items():
+                for waiter in waiters:
+                    if self.has_room(waiter.key):
+                        return priority, client, waiter
+        return None
+
+    def wake(self):
+        while self.waiting_count > 0:
+            found = self.next_waiter()
+            if found is None:
+                return
+            priority, client, waiter = found
+            self.remove(priority, client, waiter)
+            # The client goes to the back of the line for its next request
+            clients = self.waiting.get(priority)
+            if clients is not None and client in clients:
+                clients.move_to_end(client)
+            self.grant(waiter.key)
+            waiter.future.set_result(None)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting_count,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
@@ -1,75 +1,19 @@
 import json
-import re
 import subprocess
 import sys
-import copy
-import io
-import numpy as np
 import torch
-import base64
 import random
-from PIL import Image
 
-# Eww. I'm sure there's a better way to do this, but it's probably not worth the effort
+from .paths import compile_path, set_path
+from .results import api_results
+from .json_object import append_entry, merge_objects, detach
+from .images import IMAGE_FORMATS, deserialize_image, lazy_images, materialize_images
+from .profiling import profiled
+from . import config
+
 def store_at_position(obj, result, path):
-    path = re.split('[\.\[]', path)
-    current = obj
-    for i in range(len(path) - 1):
-        next_is_list = path[i + 1][-1] == "]"
-        if path[i] == "]":
-            assert isinstance(current, list)
-            if next_is_list:
-                current.append([])
-            else:
-                current.append({})
-            current = current[-1]
-        elif path[i][-1] == "]":
-            assert isinstance(current, list)
-            key = int(path[i][:-1])
-            if key == -1 and len(current) == 0:
-                key = 0
-            if key >= len(current):
-                current += [None] * (key - len(current) + 1)
-            if current[key] is None:
-                if next_is_list:
-                    current[key] = []
-                else:
-                    current[key] = {}
-            current = current[key]
-        elif path[i] not in current:
-            key = path[i]
-            if next_is_list:
-                current[key] = []
-            else:
-                current[key] = {}
-            current = current[key]
-        else:
-            current = current[path[i]]
-
-    last = path[-1]
-    if last == "]":
-        current.append(result)
-    elif last[-1] == "]":
-        key = int(last[:-1])
-        if key >= len(current):
-            current += [None] * (key - len(current) + 1)
-        current[key] = result
-    else:
-        current[last] = result
-
-
-def serialize_image(images):
-    B, H, W, C = images.shape
-    results = []
-    for b in range(B):
-        image = images[b] * 255
-        array = image.cpu().numpy()
-        im = Image.fromarray(np.uint8(array))
-        im.convert('RGBA')
-        f = io.BytesIO()
-        im.save(f, format='PNG')
-        results.append(base64.b64encode(f.getvalue()).decode("utf-8"))
-    return results
+    set_path(obj, compile_path(path), result)
+
 
 def default_serialize(value):
     return value
@@ -102,11 +46,7 @@ def GenericSerializeNodeFactory(name, arg_type, serialize_function=default_seria
 
         def output(self, value, path, json_object_optional=None):
             output = serialize_function(value)
-            if json_object_optional is None:
-                return ([(path, output)],)
-            else:
-                # return (copy.deepcopy(json_object_optional) + [(path, output)],)
-                return (json_object_optional + [(path, output)],)
+            return (append_entry(json_object_optional, path, output),)
 
     GenericSerializeNode.__name__ = name
     return GenericSerializeNode
@@ -124,6 +64,9 @@ class APISerializeNode:
             },
             "optional": {
                 "json_object_optional": ("JSON_OBJECT",),
+                "image_format": (IMAGE_FORMATS,),
+                "quality": ("INT", {"default": 95, "min": 1, "max": 100}),
+                "compress_level": ("INT", {"default": 4, "min": 0, "max": 9}),
             },
         }
 
@@ -132,33 +75,12 @@ class APISerializeNode:
 
     CATEGORY = "API Output"
 
-    def output(self, path, value, json_object_optional=None):
+    @profiled("APISerializeNode.output")
+    def output(self, path, value, json_object_optional=None, image_format="png", quality=95, compress_level=4):
         if isinstance(value, torch.Tensor):
-            value = serialize_image(value)
-
-        if json_object_optional is None:
-            return ([(path, value)],)
-        else:
-            # return (copy.deepcopy(json_object_optional) + [(path, output)],)
-            return (json_object_optional + [(path, value)],)
-
-def deserialize_image(image_input):
-    if not isinstance(image_input, list):
-        image_input = [image_input]
-
-    result = None
-    for image_string in image_input:
-        decoded = base64.b64decode(image_string)
-        image = Image.open(io.BytesIO(decoded)).convert('RGB')
-        # image.save("/home/guill/Desktop/test_result.png", format="PNG")
-        image_array = np.array(image).astype(np.float32)
-        tensor = torch.from_numpy(image_array / 255.0)
-        tensor = tensor.unsqueeze(0)
-        if result is None:
-            result = tensor
-        else:
-            result = torch.cat([result, tensor], dim=0)
-    return result
+            value = lazy_images(value, image_format, quality, compress_level)
+
+        return (append_entry(json_object_optional, path, value),)
 
 def default_deserialize(value):
     return value
@@ -225,11 +147,7 @@ class SerializeImageNode:
 
     def output(self, image, path, json_object_optional=None):
         output = "The image goes here"
-        if json_object_optional is None:
-            return ([(path, output)],)
-        else:
-            # return (copy.deepcopy(json_object_optional) + [(path, output)],)
-            return (json_object_optional + [(path, output)],)
+        return (append_entry(json_object_optional, path, output),)
 
 class APIOutputNode:
     def __init__(self):
@@ -247,6 +165,9 @@ class APIOutputNode:
                 "extra_object4": ("JSON_OBJECT",),
                 "extra_object5": ("JSON_OBJECT",),
             },
+            "hidden": {
+                "result_key": ("STRING",),
+            },
         }
 
     FUNCTION = "output"
@@ -255,23 +176,18 @@ class APIOutputNode:
 
     CATEGORY = "API Output"
 
-    def output(self, json_object, extra_object2=None, extra_object3=None, extra_object4=None, extra_object5=None):
-        obj = json_object
-        if extra_object2 is not None:
-            obj = obj + extra_object2
-        if extra_object3 is not None:
-            obj = obj + extra_object3
-        if extra_object4 is not None:
-            obj = obj + extra_object4
-        if extra_object5 is not None:
-            obj = obj + extra_object5
+    @profiled("APIOutputNode.output")
+    def output(self, json_object, extra_object2=None, extra_object3=None, extra_object4=None, extra_object5=None, result_key=None):
+        obj = merge_objects(json_object, extra_object2, extra_object3, extra_object4, extra_object5)
 
         output = {}
-        for i in range(len(obj)):
-            path, value = obj[i]
-            store_at_position(output, copy.deepcopy(value), path)
+        for path, value in obj.items():
+            store_at_position(output, detach(value), path)
 
-        return { "ui": { "api_output": [output] } }
+        # When an API request is waiting on this prompt, the result goes to it directly
+        if result_key is not None and api_results.publish(result_key, output) and not config.KEEP_HISTORY:
+            return {}
+        return { "ui": { "api_output": [materialize_images(output)] } }
 
 class APIInputNode:
     def __init__(self):
@@ -297,6 +213,7 @@ class APIInputNode:
 
     CATEGORY = "API Input"
 
+    @profiled("APIInputNode.input")
     def input(self, path, kind, default_string = None, default_input = None, api_value = None):
         value = api_value
         if value is None:
@@ -372,18 +289,8 @@ class MergeJSONObjectsNode:
 
     CATEGORY = "API Output"
 
-    def merge(self, json_object, extra_object2=None, extra_object3=None, extra_object4=None, extra_object5=None):
-        obj = json_object
-        if extra_object2 is not None:
-            obj = obj + extra_object2
-        if extra_object3 is not None:
-            obj = obj + extra_object3
-        if extra_object4 is not None:
-            obj = obj + extra_object4
-        if extra_object5 is not None:
-            obj = obj + extra_object5
-
-        return (obj,)
+    def merge(self, json_object1, extra_object2=None, extra_object3=None, extra_object4=None, extra_object5=None):
+        return (merge_objects(json_object1, extra_object2, extra_object3, extra_object4, extra_object5),)
 
 NODE_CLASS_MAPPINGS = {
     "API Output": APIOutputNode,
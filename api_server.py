@@ -1,13 +1,33 @@
 from server import PromptServer
 from .builder import GraphBuilder
+from .registry import EndpointRegistry
+from .paths import PathError, compile_path, compile_read_path, get_path, set_path
+from .channel import PromptChannel, PromptExecutionError, PromptValidationError
+from .results import api_results
+from .responses import result_response, sse_event, with_references
+from .images import EncodedImage, collect_images, encode_all, encode_preview, image_pool, replace_images
+from .cache import DiskTier, LRUStore, ResultCache
+from .batching import SHARED_NODES, BatchScheduler
+from .jobs import Job, JobStore
+from .node_defs import node_definitions
+from .prewarm import WARMUP_SUFFIX, Prewarmer, list_endpoints
+from .metrics import Gauge, LoopLagMonitor, PhaseTimer, current_timer, loop_lag, metrics, phase, phase_duration, request_bytes, request_duration, requests_total, response_bytes
+from .profiling import profiler
+from .recorder import RequestRecorder
+from .admission import PRIORITIES, AdmissionController, AdmissionRejected
+from .uploads import upload_store
+from .offload import json_loads, run_off_loop
+from . import config
 import aiohttp
 from aiohttp import web
+import asyncio
+import collections
 import os
 import base64
 from folder_paths import base_path
-import json
-import re
 import random
+import threading
+import time
 import uuid
 
 def base64_encode_image(image_path):
@@ -15,14 +35,11 @@ def base64_encode_image(image_path):
         encoded_string = base64.b64encode(image_file.read())
     return encoded_string.decode('utf-8')
 
-def get_input_link(node, input_name):
-    inputs = node.get("inputs")
-    if inputs is None:
+def get_input_link(slots, input_name):
+    input = slots.get(input_name)
+    if input is None:
         return True, None
-    for input in inputs:
-        if input["name"] == input_name:
-            return "widget" in input, input["link"]
-    return True, None
+    return "widget" in input, input["link"]
 
 def merge_dict_recursive(dict1, dict2):
     """
@@ -56,9 +73,11 @@ def instantiate_from_save(node_defs, graph):
         else:
             node_def = node_defs[node["type"]]
             cached_inputs[id] = node_def["input_order"].get("required", []) + node_def["input_order"].get("optional", [])
+        # Maps input names to their slot so each input isn't a linear search
+        slots = {input["name"]: input for input in node.get("inputs") or []}
         widget_index = 0
         for input in cached_inputs[id]:
-            has_widget, link = get_input_link(node, input)
+            has_widget, link = get_input_link(slots, input)
             if has_widget:
                 widgets_values = node.get("widgets_values")
                 if widgets_values is not None:
@@ -96,42 +115,353 @@ def instantiate_from_save(node_defs, graph):
 
 def read_at_position(obj, path):
     try:
-        path = re.split('[\.\[]', path)
-        current = obj
-        for i in range(len(path)):
-            if path[i][-1] == "]":
-                assert isinstance(current, list)
-                key = int(path[i][:-1])
-                current = current[key]
-            else:
-                current = current[path[i]]
-        return current
-    except:
+        return get_path(obj, compile_read_path(path))
+    except PathError as e:
+        print("Error:", e)
         return None
 
-def resolve_request(graph, body):
+class Binding:
+    """
+    A single request value that has to be patched into the prompt -- the node and input it goes
+    to, the path it is read from and how the raw value is converted.
+    """
+    def __init__(self, node_id, input_name, steps, coerce, clear_inputs=()):
+        self.node_id = node_id
+        self.input_name = input_name
+        self.steps = steps
+        self.coerce = coerce
+        self.clear_inputs = clear_inputs
+
+def random_seed(value):
+    seed = -1
+    if value is not None:
+        seed = int(value)
+    if seed == -1:
+        seed = random.randint(0, 0xffffffffffffffff)
+    return seed
+
+def compile_binding_path(node):
+    path = node.get_input("path")
+    if not isinstance(path, str):
+        print("Error: path is not a string:", path)
+        return None
+    try:
+        return compile_read_path(path)
+    except PathError as e:
+        print("Error in node {}:".format(node.id), e)
+        return None
+
+def compile_bindings(graph):
+    bindings = []
     for id, node in graph.nodes.items():
         if node.class_type == "Input (API)":
-            path = node.get_input("path")
-            if isinstance(path, str):
-                value = read_at_position(body, path)
-                if value is not None:
-                    node.set_input("api_value", value)
-                    node.set_input("default_input", None)
-                    node.set_input("default_string", None)
-            else:
-                print("Error: path is not a string:", path)
+            steps = compile_binding_path(node)
+            if steps is not None:
+                bindings.append(Binding(id, "api_value", steps, None, ("default_input", "default_string")))
         elif node.class_type == "Random Seed Input (API)":
-            path = node.get_input("path")
-            seed = -1
-            if isinstance(path, str):
-                value = read_at_position(body, path)
-                if value is not None:
-                    seed = int(value)
-            if seed == -1:
-                seed = random.randint(0, 0xffffffffffffffff)
-            node.set_input("seed", seed)
-    return graph
+            bindings.append(Binding(id, "seed", compile_binding_path(node), random_seed))
+    return bindings
+
+def is_truthy(value):
+    # Values from query strings and form fields are always strings
+    if isinstance(value, str):
+        return value.lower() not in ("", "false", "0")
+    return bool(value)
+
+def value_to_string(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+class Switch:
+    """
+    A Switch (API) or Value Switch (API) node. Both pick one of two inputs based only on the request,
+    so the choice can be made before the prompt is submitted.
+    """
+    def __init__(self, node_id, steps, true_input, false_input, value_string=None):
+        self.node_id = node_id
+        self.steps = steps
+        self.true_input = true_input
+        self.false_input = false_input
+        self.value_string = value_string
+
+    def evaluate(self, body):
+        value = get_path(body, self.steps)
+        if value is None:
+            return False
+        if self.value_string is None:
+            return is_truthy(value)
+        return value_to_string(value) == self.value_string
+
+def compile_switches(graph):
+    switches = []
+    for id, node in graph.nodes.items():
+        if node.class_type == "Switch (API)":
+            steps = compile_binding_path(node)
+            if steps is not None:
+                switches.append(Switch(id, steps, "on_true", "on_false"))
+        elif node.class_type == "Value Switch (API)":
+            steps = compile_binding_path(node)
+            value_string = node.get_input("value_string")
+            if steps is not None and isinstance(value_string, str):
+                switches.append(Switch(id, steps, "on_equal", "on_not_equal", value_string))
+    return switches
+
+def compile_linked_defaults(graph):
+    # Input (API) nodes whose default comes from another node -- that node is dead when the value is given
+    defaults = []
+    for id, node in graph.nodes.items():
+        if node.class_type == "Input (API)" and isinstance(node.get_input("default_input"), list):
+            steps = compile_binding_path(node)
+            if steps is not None:
+                defaults.append((id, steps))
+    return defaults
+
+def prune_graph(graph, switches, outcomes, defaults, provided, node_defs):
+    """
+    Returns a copy of the graph with each switch replaced by the input it selects and the defaults of
+    provided inputs disconnected, minus every node that no longer contributes to an output.
+    """
+    g = graph.copy()
+    for (node_id, steps), is_provided in zip(defaults, provided):
+        if is_provided:
+            g.lookup_node(node_id).set_input("default_input", None)
+    for switch, outcome in zip(switches, outcomes):
+        node = g.lookup_node(switch.node_id)
+        selected = node.get_input(switch.true_input if outcome else switch.false_input)
+        # With nothing connected to the selected side, leave it to the switch to decide what that means
+        if selected is None:
+            continue
+        g.replace_node_output(switch.node_id, 0, selected)
+        g.remove_node(switch.node_id)
+
+    def is_output(node):
+        node_def = node_defs.get(node.class_type)
+        return node_def is None or node_def.get("output_node", False)
+    g.prune(is_output)
+    return g
+
+class EndpointVariant:
+    """
+    The prompt for one combination of switch outcomes, along with the bindings needed to specialize
+    it for a request. Shared between requests, so none of it may be modified.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.prompt = graph.finalize()
+        self.bindings = compile_bindings(graph)
+        self.output_nodes = [id for id, node in graph.nodes.items() if node.class_type == "API Output"]
+        self.random_nodes = [id for id, node in graph.nodes.items() if node.class_type == "Random Seed (API)"]
+
+class CompiledEndpoint:
+    """
+    An endpoint's graph and the switches within it. A variant of the prompt with dead branches
+    removed is compiled the first time each combination of switch outcomes (and of provided inputs
+    with a default from another node) is requested. The most recently used ENDPOINT_VARIANTS
+    variants are kept, since there can be exponentially many combinations.
+    """
+    def __init__(self, graph, node_defs, path, version):
+        self.graph = graph
+        self.node_defs = node_defs
+        self.path = path
+        self.version = version
+        self.switches = compile_switches(graph)
+        self.defaults = compile_linked_defaults(graph)
+        self.variants = collections.OrderedDict()
+        # Requests are resolved on several threads at once
+        self.lock = threading.Lock()
+
+    def variant_for(self, body):
+        key = (tuple(switch.evaluate(body) for switch in self.switches), tuple(get_path(body, steps) is not None for node_id, steps in self.defaults))
+        with self.lock:
+            variant = self.variants.get(key)
+            if variant is None:
+                variant = EndpointVariant(prune_graph(self.graph, self.switches, key[0], self.defaults, key[1], self.node_defs))
+                self.variants[key] = variant
+                while len(self.variants) > max(1, config.ENDPOINT_VARIANTS):
+                    self.variants.popitem(last=False)
+            else:
+                self.variants.move_to_end(key)
+            return variant
+
+def resolve_request(variant, body):
+    # Copy on write: only nodes whose inputs a binding sets get their own, everything else is shared
+    # with the template. Nothing downstream may modify a prompt's inputs in place -- merge_prompts
+    # and bind_result_key build new nodes, and ComfyUI only reads them.
+    prompt = dict(variant.prompt)
+    for binding in variant.bindings:
+        value = None
+        if binding.steps is not None:
+            value = get_path(body, binding.steps)
+        if binding.coerce is not None:
+            value = binding.coerce(value)
+        elif value is None:
+            continue
+
+        node = prompt[binding.node_id]
+        if node is variant.prompt[binding.node_id]:
+            node = { "class_type": node["class_type"], "inputs": dict(node["inputs"]) }
+            prompt[binding.node_id] = node
+        inputs = node["inputs"]
+        inputs[binding.input_name] = value
+        for key in binding.clear_inputs:
+            inputs.pop(key, None)
+    return prompt
+
+def is_deterministic(variant, body):
+    """
+    Whether the request fully determines the prompt's result, i.e. it doesn't rely on any seed
+    being picked at random.
+    """
+    if len(variant.random_nodes) > 0:
+        return False
+    for binding in variant.bindings:
+        if binding.coerce is random_seed:
+            value = None
+            if binding.steps is not None:
+                value = get_path(body, binding.steps)
+            if value is None or int(value) == -1:
+                return False
+    return True
+
+def bind_result_key(variant, prompt, key):
+    # Tells the API Output nodes which request to deliver their results to
+    for node_id in variant.output_nodes:
+        node = prompt[node_id]
+        prompt[node_id] = { "class_type": node["class_type"], "inputs": dict(node["inputs"], result_key=key) }
+    return prompt
+
+MULTIPART_CHUNK_BYTES = 1024 * 1024
+
+async def read_part(part, total, limit):
+    # total is what earlier parts of the request came to
+    data = bytearray()
+    while True:
+        chunk = await part.read_chunk(MULTIPART_CHUNK_BYTES)
+        if len(chunk) == 0:
+            return bytes(data)
+        data += chunk
+        if total + len(data) > limit:
+            raise web.HTTPRequestEntityTooLarge(max_size=limit, actual_size=total + len(data))
+
+async def read_multipart_body(request):
+    """
+    Reads a multipart/form-data request. A part named "json" holds the base body, every other
+    part is stored at the path given by its name. Files are kept as raw bytes in the upload store
+    and only a token referencing them goes into the body.
+    """
+    body = {}
+    fields = []
+    uploads = []
+    # The same limit aiohttp applies to other bodies, which it can't for parts read one at a time
+    limit = request._client_max_size
+    total = 0
+    try:
+        reader = await request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if part.name is None:
+                continue
+            content_type = part.headers.get("Content-Type", "text/plain")
+            data = await read_part(part, total, limit)
+            total += len(data)
+            if part.name == "json" and part.filename is None:
+                data = part.decode(data)
+                body = json_loads(data) if len(data) > 0 else None
+                if not isinstance(body, dict):
+                    raise web.HTTPBadRequest(reason="The json part must contain an object.")
+            elif part.filename is None and content_type.startswith("text/"):
+                fields.append((part.name, part.decode(data).decode(part.get_charset(default="utf-8"))))
+            else:
+                token = upload_store.put(data)
+                uploads.append(token)
+                fields.append((part.name, token))
+
+        # Applied after the json part so fields can be sent in any order
+        for name, value in fields:
+            try:
+                set_path(body, compile_path(name), value)
+            except PathError as e:
+                raise web.HTTPBadRequest(reason="Invalid field name: {}".format(e))
+    except:
+        upload_store.release(uploads)
+        raise
+    return body, uploads
+
+def resolve_variant(endpoint, body):
+    variant = endpoint.variant_for(body)
+    return variant, resolve_request(variant, body)
+
+def merge_outputs(outputs):
+    result = {}
+    for x in outputs:
+        result = merge_dict_recursive(result, x)
+    return result
+
+async def read_request_body(request):
+    with phase("parse"):
+        if request.content_type == "multipart/form-data":
+            return await read_multipart_body(request)
+        return json_loads(await request.read()), []
+
+def request_priority(request, endpoint_name):
+    priority = request.headers.get("X-Priority") or config.ENDPOINT_PRIORITY.get(endpoint_name, "normal")
+    if priority in PRIORITIES:
+        return PRIORITIES[priority]
+    try:
+        return int(priority)
+    except ValueError:
+        raise web.HTTPBadRequest(reason="X-Priority must be one of {} or an integer.".format(", ".join(PRIORITIES)))
+
+def request_client(request):
+    # Requests are queued fairly between clients, identified by X-Client-Id or their address
+    return request.headers.get("X-Client-Id") or request.remote
+
+def request_profiling(request):
+    """
+    Whether to profile a request's prompt, and whether to also run cProfile on it. X-Profile is
+    "1" to profile the request or "cprofile" for both.
+    """
+    value = request.headers.get("X-Profile", "")
+    if value.lower() == "cprofile":
+        return True, True
+    return config.PROFILE or is_truthy(value), False
+
+def request_timeout(request):
+    timeout = request.headers.get("X-Timeout")
+    if timeout is None:
+        return config.REQUEST_TIMEOUT or None
+    try:
+        return float(timeout)
+    except ValueError:
+        raise web.HTTPBadRequest(reason="X-Timeout must be a number of seconds.")
+
+class ClientDisconnected(Exception):
+    pass
+
+def is_disconnected(request):
+    transport = request.transport
+    return transport is None or transport.is_closing()
+
+async def until_disconnected(request, coroutine, interval):
+    """
+    Runs coroutine, cancelling it and raising ClientDisconnected if the client goes away first.
+    Cancelling a request's execution stops its prompt, so it doesn't run for nobody.
+    """
+    task = asyncio.ensure_future(coroutine)
+    try:
+        while True:
+            done, pending = await asyncio.wait([task], timeout=interval)
+            if len(done) > 0:
+                return task.result()
+            if is_disconnected(request):
+                task.cancel()
+                raise ClientDisconnected()
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
 
 def query_to_dict(query):
     d = {}
@@ -139,16 +469,65 @@ def query_to_dict(query):
         d[key] = value
     return d
 
-cached_objects = None
+# Routes whose requests are timed and counted in the metrics
+def metered_endpoint(endpoint_name):
+    # Only endpoints that exist are used as metric labels, so made up names can't add series without end
+    timer = current_timer.get()
+    if timer is not None:
+        timer.endpoint = endpoint_name
+
+METERED_ROUTES = [
+    "/api/{endpoint_name}",
+    "/api/{endpoint_name}/stream",
+    "/api/{endpoint_name}/ws",
+    "/api/{endpoint_name}/jobs",
+    "/api/{endpoint_name}/jobs/{job_id}/result",
+    "/sdapi/v1/{endpoint_name}",
+    "/sdapi/v1/{endpoint_name}/stream",
+    "/sdapi/v1/{endpoint_name}/ws",
+    "/sdapi/v1/{endpoint_name}/jobs",
+    "/sdapi/v1/{endpoint_name}/jobs/{job_id}/result",
+]
+
+def response_size(response):
+    if isinstance(response, web.Response):
+        return len(response.body) if isinstance(response.body, bytes) else 0
+    # Streamed responses have already been written by now
+    return response.body_length
+
+# Events from the executor that are passed on to streaming requests
+STREAM_EVENTS = ["execution_start", "execution_cached", "executing", "progress"]
+
+endpoint_registry = EndpointRegistry()
 def init_api_server():
     routes = PromptServer.instance.routes
+    channel = PromptChannel(PromptServer.instance)
+
+    result_cache = None
+    if config.RESULT_CACHE:
+        disk = None
+        if config.RESULT_CACHE_DISK:
+            disk = DiskTier(os.path.join(base_path, "api_cache"), config.RESULT_CACHE_DISK_BYTES)
+        store = LRUStore(config.RESULT_CACHE_ENTRIES, config.RESULT_CACHE_BYTES, ttl=config.RESULT_CACHE_TTL or None, disk=disk)
+        result_cache = ResultCache(store)
+
+    jobs_disk = None
+    if config.JOB_RESULTS_DISK:
+        jobs_disk = DiskTier(os.path.join(base_path, "api_jobs"), config.JOB_RESULTS_DISK_BYTES)
+    job_store = JobStore(LRUStore(config.JOB_RESULTS_ENTRIES, config.JOB_RESULTS_BYTES, ttl=config.JOB_RESULTS_TTL or None, disk=jobs_disk))
+    # Keeps running jobs' tasks from being garbage collected
+    job_tasks = set()
+
+    admission = AdmissionController(config.MAX_CONCURRENT, config.MAX_CONCURRENT_PER_ENDPOINT, config.MAX_WAITING, config.ENDPOINT_CONCURRENCY)
+
+    recorder = None
+    if config.RECORD_REQUESTS != "":
+        recorder = RequestRecorder(os.path.join(base_path, config.RECORD_REQUESTS), config.RECORD_SAMPLE_RATE, config.RECORD_IMAGES)
 
     @routes.get('/api_endpoints')
     async def api_endpoints(request):
         endpoints_path = os.path.join(base_path, "endpoints")
-        files = [f for f in os.listdir(endpoints_path) if os.path.isfile(os.path.join(endpoints_path, f)) and f.endswith(".json")]
-        files = [os.path.splitext(f)[0] for f in files]
-        return web.json_response(files)
+        return web.json_response(list_endpoints(endpoints_path))
 
     def get_best_type(t1, t2):
         if t1 is None:
@@ -231,8 +610,7 @@ def init_api_server():
     async def api_info(request):
         endpoint_name = request.match_info['endpoint_name']
         endpoints_path = os.path.join(base_path, "endpoints")
-        graph = await api_instantiate(endpoint_name, endpoints_path)
-        assert graph is not None
+        graph = (await api_instantiate(endpoint_name, endpoints_path)).graph
         node_defs = await get_node_defs()
 
         inputs = {}
@@ -276,109 +654,579 @@ def init_api_server():
         body = query_to_dict(request.rel_url.query)
         endpoint_name = request.match_info['endpoint_name']
         endpoints_path = os.path.join(base_path, "endpoints")
-        return await api_endpoint(endpoint_name, endpoints_path, body)
+        return await api_endpoint(request, endpoint_name, endpoints_path, body)
 
     @routes.post('/api/{endpoint_name}')
     async def api_endpoint_post(request):
-        body = await request.json()
+        body, uploads = await read_request_body(request)
         endpoint_name = request.match_info['endpoint_name']
         endpoints_path = os.path.join(base_path, "endpoints")
-        return await api_endpoint(endpoint_name, endpoints_path, body)
+        try:
+            return await api_endpoint(request, endpoint_name, endpoints_path, body)
+        finally:
+            upload_store.release(uploads)
 
     @routes.get('/sdapi/v1/{endpoint_name}')
     async def sdapi_endpoint_get(request):
         body = query_to_dict(request.rel_url.query)
         endpoint_name = request.match_info['endpoint_name']
         endpoints_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi")
-        return await api_endpoint(endpoint_name, endpoints_path, body)
+        return await api_endpoint(request, endpoint_name, endpoints_path, body)
 
     @routes.post('/sdapi/v1/{endpoint_name}')
     async def sdapi_endpoint_post(request):
         # A special case -- attempted compatibility with the automatic1111 API
-        body = await request.json()
+        body, uploads = await read_request_body(request)
         endpoint_name = request.match_info['endpoint_name']
         endpoints_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi")
-        return await api_endpoint(endpoint_name, endpoints_path, body)
-
-    def get_address():
-        address = PromptServer.instance.address
-        port = PromptServer.instance.port
-        if address == "0.0.0.0":
-            address = "127.0.0.1"
-        return "http://" + address + ":" + str(port)
-
-    def get_ws_address():
-        address = PromptServer.instance.address
-        port = PromptServer.instance.port
-        if address == "0.0.0.0":
-            address = "127.0.0.1"
-        return "ws://" + address + ":" + str(port)
+        try:
+            return await api_endpoint(request, endpoint_name, endpoints_path, body)
+        finally:
+            upload_store.release(uploads)
 
     async def api_getprompt(endpoint_name, endpoints_path, body):
-        instantiated = await api_instantiate(endpoint_name, endpoints_path)
-        resolved = resolve_request(instantiated, body)
-        prompt = { "prompt": resolved.finalize() }
+        endpoint = await api_instantiate(endpoint_name, endpoints_path)
+        prompt = { "prompt": resolve_request(endpoint.variant_for(body), body) }
         return prompt
 
     async def get_node_defs():
-        global cached_objects
-        if cached_objects is None:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(get_address() + '/object_info') as resp:
-                    cached_objects = await resp.json()
-        return cached_objects
+        version, node_defs = await node_definitions.get()
+        return node_defs
 
     async def api_instantiate(endpoint_name, endpoints_path):
         endpoint_path = os.path.join(endpoints_path, endpoint_name + ".json")
-        if not os.path.exists(endpoint_path) or endpoints_path != os.path.commonpath([endpoints_path, endpoint_path]):
+        if not os.path.exists(endpoint_path) or endpoints_path != os.path.commonpath([endpoints_path, endpoint_path]) or endpoint_path.endswith(WARMUP_SUFFIX):
             raise web.HTTPNotFound(reason="No such endpoint available.")
 
-        # Read the file specified by endpoint_name
+        with phase("instantiate"):
+            defs_version, node_defs = await node_definitions.get()
+
+            # The registry only reads and compiles the file when it or the node definitions have changed
+            try:
+                endpoint = await run_off_loop(endpoint_registry.get, endpoint_path, lambda graph, version: CompiledEndpoint(instantiate_from_save(node_defs, graph), node_defs, endpoint_path, version), defs_version)
+            except (OSError, ValueError):
+                raise web.HTTPNotFound(reason="Could not load endpoint.")
+
+        metered_endpoint(endpoint_name)
+        return endpoint
+
+    async def run_prompt(prompt, prompt_id, listener=None):
+        """
+        Runs a prompt to completion and returns the UI outputs from its history, by node id.
+        """
+        try:
+            try:
+                await channel.submit(prompt, prompt_id, listener)
+            except asyncio.CancelledError:
+                # Nobody is waiting for the result any more, so don't run it if it hasn't started
+                channel.cancel(prompt_id)
+                raise
+        finally:
+            with phase("history"):
+                history = channel.get_history(prompt_id)
+                if not config.KEEP_HISTORY:
+                    channel.delete_history(prompt_id)
+        return history["outputs"] if history is not None else {}
+
+    batch_scheduler = None
+    if config.BATCH_WINDOW_MS > 0:
+        shared_nodes = SHARED_NODES | set(config.BATCH_SHARED_NODES)
+        batch_scheduler = BatchScheduler(config.BATCH_WINDOW_MS / 1000, config.BATCH_MAX_SIZE, run_prompt, channel.validate, lambda node: node["class_type"] in shared_nodes)
+
+    async def execute_prompt(variant, prompt, listener=None):
+        result_key = str(uuid.uuid4())
+        prompt = bind_result_key(variant, prompt, result_key)
+        api_results.expect(result_key)
+        try:
+            if batch_scheduler is not None:
+                # Requests for the same variant only differ in their inputs, so they can share a prompt.
+                # Each one finishes once its own API Output nodes have delivered, not the whole batch.
+                ready = api_results.ready(result_key, len(variant.output_nodes)) if len(variant.output_nodes) > 0 else None
+                ui_outputs = await batch_scheduler.submit(variant, prompt, variant.output_nodes, listener, ready)
+            else:
+                ui_outputs = await run_prompt(prompt, result_key, listener)
+        finally:
+            outputs = api_results.collect(result_key)
+
+        if not outputs:
+            # Output nodes that don't know about the result store still report through the history
+            outputs = []
+            for node_id in ui_outputs:
+                outputs.extend(ui_outputs[node_id].get("api_output", []))
+
+        with phase("merge"):
+            return await run_off_loop(merge_outputs, outputs)
+
+    async def execute_cacheable(variant, prompt, listener=None):
+        result = await execute_prompt(variant, prompt, listener)
+        await encode_all(collect_images(result))
+        return result
+
+    async def execute_request(endpoint, variant, body, prompt, headers, listener=None):
+        if result_cache is None:
+            return await execute_prompt(variant, prompt, listener)
+        elif is_deterministic(variant, body):
+            key = await run_off_loop(result_cache.key_for, endpoint.path, endpoint.version, prompt)
+            result, headers["X-Cache"] = await result_cache.get_or_compute(key, lambda: execute_cacheable(variant, prompt, listener))
+            return result
+        headers["X-Cache"] = "BYPASS"
+        return await execute_prompt(variant, prompt, listener)
+
+    async def run_endpoint(request, endpoint, endpoint_name, body, headers, listener=None, detached=False):
+        """
+        Runs a request to an endpoint and returns its result. Unless it's detached from the client
+        that made it, it's cancelled if that client disconnects.
+        """
+        with phase("resolve"):
+            variant, prompt = await run_off_loop(resolve_variant, endpoint, body)
+        profile, cprofile = request_profiling(request)
+        if profile:
+            inner_listener = listener
+            def listener(event, data):
+                if event == "submitted":
+                    profiler.expect(data["prompt_id"], cprofile)
+                    # Where to find the profile once the request is done
+                    headers["X-Prompt-Id"] = data["prompt_id"]
+                if inner_listener is not None:
+                    inner_listener(event, data)
+        timer = current_timer.get()
+        if timer is not None:
+            listener = timer.wrap(listener)
+        timeout = request_timeout(request)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        watch = config.DISCONNECT_POLL_MS > 0 and not detached
+        with phase("admission"):
+            acquisition = admission.acquire(endpoint_name, request_priority(request, endpoint_name), request_client(request), timeout)
+            if watch:
+                # A client that leaves while waiting never gets a slot, so no prompt runs for nobody.
+                # Cancelling acquire hands back a slot that was granted just as the client left.
+                acquired_at = await until_disconnected(request, acquisition, config.DISCONNECT_POLL_MS / 1000)
+            else:
+                acquired_at = await acquisition
+        try:
+            # Whatever is left of the timeout after waiting for a slot
+            remaining = deadline - loop.time() if deadline is not None else None
+            execution = asyncio.wait_for(execute_request(endpoint, variant, body, prompt, headers, listener), remaining)
+            if watch:
+                return await until_disconnected(request, execution, config.DISCONNECT_POLL_MS / 1000)
+            return await execution
+        finally:
+            admission.release(endpoint_name, acquired_at)
+
+    def error_details(e):
+        """
+        The status, JSON body and headers to report an error from run_endpoint with, or None if it
+        isn't one that's reported to the client.
+        """
+        if isinstance(e, AdmissionRejected):
+            return 429, { "error": str(e) }, { "Retry-After": str(e.retry_after) }
+        elif isinstance(e, asyncio.TimeoutError):
+            return 504, { "error": "The request did not complete in time." }, {}
+        elif isinstance(e, PromptValidationError):
+            return 400, { "error": e.error, "node_errors": e.node_errors }, {}
+        elif isinstance(e, PromptExecutionError):
+            print("Error:", e)
+            return 500, { "error": e.data }, {}
+        elif isinstance(e, web.HTTPException):
+            return e.status, { "error": e.reason }, {}
+        return None
+
+    async def api_endpoint(request, endpoint_name, endpoints_path, body):
+        if recorder is None or not recorder.sampled():
+            return await respond(request, endpoint_name, endpoints_path, body)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await respond(request, endpoint_name, endpoints_path, body)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            recorder.record(request.method, request.path, dict(request.rel_url.query), body, status, time.perf_counter() - start)
+
+    async def respond(request, endpoint_name, endpoints_path, body):
+        endpoint = await api_instantiate(endpoint_name, endpoints_path)
+        headers = {}
+        try:
+            result = await run_endpoint(request, endpoint, endpoint_name, body, headers)
+        except ClientDisconnected:
+            # There's no one to send anything to
+            return web.Response(status=499)
+        except (AdmissionRejected, asyncio.TimeoutError, PromptValidationError, PromptExecutionError) as e:
+            status, data, error_headers = error_details(e)
+            return web.json_response(data, status=status, headers=error_headers)
+        with phase("encode"):
+            return await result_response(request, result, headers)
+
+    async def stream_endpoint(request, endpoint, endpoint_name, body, send, send_result):
+        """
+        Runs a request, calling send(event, data) with its progress as it happens and then
+        send_result(result) or send("error", ...) at the end. send(None, None) keeps the connection
+        alive when nothing has happened for a while.
+        """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        previews = is_truthy(request.rel_url.query.get("previews", ""))
+        last_preview = None
+
+        def listener(event, data):
+            nonlocal last_preview
+            if event in STREAM_EVENTS:
+                events.put_nowait((event, data))
+            elif previews and isinstance(data, (list, tuple)) and len(data) == 3:
+                now = loop.time()
+                if last_preview is None or now - last_preview >= config.PREVIEW_INTERVAL_MS / 1000:
+                    last_preview = now
+                    events.put_nowait(("preview", data))
+
+        task = asyncio.ensure_future(run_endpoint(request, endpoint, endpoint_name, body, {}, listener))
+        # Marks the end of the events, after any that were sent before the request finished
+        task.add_done_callback(lambda task: events.put_nowait(None))
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(events.get(), config.STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await send(None, None)
+                    continue
+                if item is None:
+                    break
+                event, data = item
+                if event == "preview":
+                    data = await loop.run_in_executor(image_pool, encode_preview, data)
+                await send(event, data)
+
+            try:
+                result = task.result()
+            except ClientDisconnected:
+                return
+            except Exception as e:
+                details = error_details(e)
+                if details is None:
+                    raise
+                status, data, error_headers = details
+                await send("error", dict(data, status=status))
+                return
+            await send_result(result)
+        finally:
+            # The client stopped listening before the request finished
+            if not task.done():
+                task.cancel()
+
+    async def sse_endpoint(request, endpoint_name, endpoints_path, body):
+        endpoint = await api_instantiate(endpoint_name, endpoints_path)
+        response = web.StreamResponse(headers={ "Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no" })
+        await response.prepare(request)
+
+        async def send(event, data):
+            await response.write(sse_event(event, data))
+
+        async def send_result(result):
+            await encode_all(collect_images(result))
+            await send("result", replace_images(result, EncodedImage.to_base64))
+
+        await stream_endpoint(request, endpoint, endpoint_name, body, send, send_result)
+        await response.write_eof()
+        return response
+
+    async def ws_endpoint(request, endpoint_name, endpoints_path):
+        endpoint = await api_instantiate(endpoint_name, endpoints_path)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        # The request body is the first message
+        msg = await ws.receive()
+        try:
+            body = json_loads(msg.data) if msg.type == aiohttp.WSMsgType.TEXT else None
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            await ws.send_json({ "type": "error", "data": { "error": "The first message must be a JSON object with the request body.", "status": 400 } })
+            await ws.close()
+            return ws
+
+        async def send(event, data):
+            if event is None:
+                await ws.ping()
+            else:
+                await ws.send_json({ "type": event, "data": data })
+
+        async def send_result(result):
+            # Images follow the result as binary messages, in the order they're referenced
+            images = collect_images(result)
+            encoded = await encode_all(images)
+            await ws.send_json({ "type": "result", "data": with_references(result, images), "images": [image.content_type for image in images] })
+            for data in encoded:
+                await ws.send_bytes(data)
+
+        await stream_endpoint(request, endpoint, endpoint_name, body, send, send_result)
+        await ws.close()
+        return ws
+
+    @routes.get('/api/{endpoint_name}/stream')
+    async def api_stream_get(request):
+        body = query_to_dict(request.rel_url.query)
+        endpoints_path = os.path.join(base_path, "endpoints")
+        return await sse_endpoint(request, request.match_info['endpoint_name'], endpoints_path, body)
+
+    @routes.post('/api/{endpoint_name}/stream')
+    async def api_stream_post(request):
+        body, uploads = await read_request_body(request)
+        endpoints_path = os.path.join(base_path, "endpoints")
+        try:
+            return await sse_endpoint(request, request.match_info['endpoint_name'], endpoints_path, body)
+        finally:
+            upload_store.release(uploads)
+
+    @routes.get('/api/{endpoint_name}/ws')
+    async def api_ws(request):
+        endpoints_path = os.path.join(base_path, "endpoints")
+        return await ws_endpoint(request, request.match_info['endpoint_name'], endpoints_path)
+
+    @routes.get('/sdapi/v1/{endpoint_name}/stream')
+    async def sdapi_stream_get(request):
+        body = query_to_dict(request.rel_url.query)
+        endpoints_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi")
+        return await sse_endpoint(request, request.match_info['endpoint_name'], endpoints_path, body)
+
+    @routes.post('/sdapi/v1/{endpoint_name}/stream')
+    async def sdapi_stream_post(request):
+        body, uploads = await read_request_body(request)
+        endpoints_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi")
         try:
-            with open(endpoint_path, "r") as f:
-                endpoint_json = f.read()
-                graph = json.loads(endpoint_json)
+            return await sse_endpoint(request, request.match_info['endpoint_name'], endpoints_path, body)
+        finally:
+            upload_store.release(uploads)
+
+    @routes.get('/sdapi/v1/{endpoint_name}/ws')
+    async def sdapi_ws(request):
+        endpoints_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi")
+        return await ws_endpoint(request, request.match_info['endpoint_name'], endpoints_path)
+
+    async def run_job(job, request, endpoint, endpoint_name, body, uploads):
+        cancelled = False
+        try:
+            result = await run_endpoint(request, endpoint, endpoint_name, body, {}, job.listener, detached=True)
+            await encode_all(collect_images(result))
+            job.complete(result)
+        except asyncio.CancelledError:
+            # e.g. the server is shutting down
+            cancelled = True
+            job.fail(503, { "error": "The job was cancelled before it finished." })
+            raise
+        except Exception as e:
+            details = error_details(e)
+            if details is None:
+                print("Error:", e)
+                details = 500, { "error": str(e) }, {}
+            status, data, error_headers = details
+            job.fail(status, data)
+        finally:
+            upload_store.release(uploads)
+            if cancelled:
+                # There may be no loop to come back to once the write is done
+                job_store.finish(job)
+            else:
+                # Writing to the disk tier is kept off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, job_store.finish, job)
+
+    async def submit_job(request, endpoint_name, endpoints_path):
+        body, uploads = await read_request_body(request)
+        try:
+            endpoint = await api_instantiate(endpoint_name, endpoints_path)
         except:
-            raise web.HTTPNotFound(reason="Could not load endpoint.")
+            upload_store.release(uploads)
+            raise
+        job = Job(endpoint.path)
+        job_store.add(job)
+        # The uploads are released when the job finishes rather than when this request does
+        task = asyncio.ensure_future(run_job(job, request, endpoint, endpoint_name, body, uploads))
+        job_tasks.add(task)
+        task.add_done_callback(job_tasks.discard)
+        jobs_url = request.path.rstrip("/")
+        return web.json_response({
+            "id": job.id,
+            "status_url": jobs_url + "/" + job.id,
+            "result_url": jobs_url + "/" + job.id + "/result",
+        }, status=202, headers={ "Location": jobs_url + "/" + job.id })
 
-        node_defs = await get_node_defs()
+    async def find_job(request, endpoints_path):
+        job = job_store.get(request.match_info['job_id'])
+        endpoint_path = os.path.join(endpoints_path, request.match_info['endpoint_name'] + ".json")
+        if job is None or job.endpoint != endpoint_path:
+            raise web.HTTPNotFound(reason="No such job.")
+        metered_endpoint(request.match_info['endpoint_name'])
+        return job
+
+    def describe_job(job):
+        queue_position = channel.queue_position(job.prompt_id) if job.status == "queued" else None
+        return job.describe(queue_position)
+
+    async def job_status(request, endpoints_path):
+        job = await find_job(request, endpoints_path)
+        return web.json_response(describe_job(job))
+
+    async def job_result(request, endpoints_path):
+        job = await find_job(request, endpoints_path)
+        if job.status == "completed":
+            return await result_response(request, job.result, {})
+        elif job.status == "failed":
+            return web.json_response(job.error, status=job.error_status)
+        # Not finished yet
+        return web.json_response(describe_job(job), status=202)
+
+    @routes.post('/api/{endpoint_name}/jobs')
+    async def api_submit_job(request):
+        return await submit_job(request, request.match_info['endpoint_name'], os.path.join(base_path, "endpoints"))
+
+    @routes.get('/api/{endpoint_name}/jobs/{job_id}')
+    async def api_job_status(request):
+        return await job_status(request, os.path.join(base_path, "endpoints"))
+
+    @routes.get('/api/{endpoint_name}/jobs/{job_id}/result')
+    async def api_job_result(request):
+        return await job_result(request, os.path.join(base_path, "endpoints"))
+
+    @routes.post('/sdapi/v1/{endpoint_name}/jobs')
+    async def sdapi_submit_job(request):
+        return await submit_job(request, request.match_info['endpoint_name'], os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi"))
+
+    @routes.get('/sdapi/v1/{endpoint_name}/jobs/{job_id}')
+    async def sdapi_job_status(request):
+        return await job_status(request, os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi"))
+
+    @routes.get('/sdapi/v1/{endpoint_name}/jobs/{job_id}/result')
+    async def sdapi_job_result(request):
+        return await job_result(request, os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi"))
+
+    async def prewarm_compile(endpoint_name, endpoints_path):
+        endpoint = await api_instantiate(endpoint_name, endpoints_path)
+        # The variant used by requests that don't set any switches
+        await run_off_loop(endpoint.variant_for, {})
+        return endpoint
+
+    async def prewarm_warm_up(endpoint, body):
+        variant, prompt = await run_off_loop(resolve_variant, endpoint, body)
+        await execute_prompt(variant, prompt)
+
+    prewarmer = Prewarmer([
+        ("/api/", os.path.join(base_path, "endpoints")),
+        ("/sdapi/v1/", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdapi")),
+    ], prewarm_compile, prewarm_warm_up)
+    if config.PREWARM:
+        # Runs once the server starts, by which point every custom node has been loaded
+        prewarmer.status = "pending"
+        PromptServer.instance.loop.call_soon(prewarmer.start, config.PREWARM_WARMUP)
+
+    @routes.post('/api_prewarm')
+    async def api_prewarm(request):
+        warmup = request.rel_url.query.get("warmup")
+        prewarmer.start(config.PREWARM_WARMUP if warmup is None else is_truthy(warmup))
+        return web.json_response(prewarmer.describe(), status=202)
+
+    @routes.get('/api_prewarm')
+    async def api_prewarm_status(request):
+        # 503 until prewarming has finished, for load balancer health checks
+        return web.json_response(prewarmer.describe(), status=200 if prewarmer.ready else 503)
+
+    in_flight = 0
+
+    @web.middleware
+    async def metrics_middleware(request, handler):
+        nonlocal in_flight
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else None
+        if route not in METERED_ROUTES:
+            return await handler(request)
+
+        timer = PhaseTimer()
+        token = current_timer.set(timer)
+        in_flight += 1
+        status = 500
+        response = None
+        try:
+            response = await handler(request)
+            status = response.status
+            if not response.prepared:
+                response.headers["Server-Timing"] = timer.server_timing()
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            in_flight -= 1
+            current_timer.reset(token)
+            endpoint = route.split("{")[0] + timer.endpoint if timer.endpoint is not None else "unknown"
+            labels = (endpoint, route, str(status))
+            request_duration.observe(labels, timer.total())
+            requests_total.inc(labels)
+            for name, seconds in timer.phases.items():
+                phase_duration.observe((endpoint, name), seconds)
+            request_bytes.inc((endpoint,), request.content_length or 0)
+            if response is not None:
+                response_bytes.inc((endpoint,), response_size(response))
+
+    PromptServer.instance.app.middlewares.append(metrics_middleware)
+
+    def cache_ratio(stats):
+        lookups = stats["hits"] + stats["misses"]
+        return stats["hits"] / lookups if lookups > 0 else None
+
+    metrics.add(Gauge("apitools_requests_in_flight", "API requests being handled.", lambda: in_flight))
+    metrics.add(Gauge("apitools_requests_waiting", "API requests waiting for admission.", lambda: admission.waiting_count))
+    metrics.add(Gauge("apitools_requests_running", "API requests admitted and running.", lambda: admission.running))
+    metrics.add(Gauge("apitools_requests_rejected_total", "API requests rejected because too many were waiting.", lambda: admission.rejected, kind="counter"))
+    metrics.add(Gauge("apitools_queue_depth", "Prompts queued or running in ComfyUI, from any client.", channel.queue_depth))
+    metrics.add(Gauge("apitools_endpoint_cache_hit_ratio", "Share of requests whose endpoint was already compiled.", lambda: cache_ratio(endpoint_registry.stats())))
+    metrics.add(Gauge("apitools_jobs_active", "Jobs that haven't finished.", lambda: len(job_store.active)))
+    if config.LOOP_LAG_INTERVAL_MS > 0:
+        lag_monitor = LoopLagMonitor(loop_lag, config.LOOP_LAG_INTERVAL_MS / 1000)
+        PromptServer.instance.loop.call_soon(lag_monitor.start)
+        metrics.add(Gauge("apitools_event_loop_lag_last_seconds", "How late the event loop ran the last scheduled callback.", lambda: lag_monitor.last))
+    metrics.add(Gauge("apitools_cancelled_work_seconds_total", "Estimated execution time saved by cancelling prompts.", lambda: channel.cancelled_seconds, kind="counter"))
+    if result_cache is not None:
+        metrics.add(Gauge("apitools_result_cache_hit_ratio", "Share of deterministic requests answered from the result cache.", lambda: cache_ratio(result_cache.stats())))
+        metrics.add(Gauge("apitools_result_cache_bytes", "Size of the results in the result cache's memory.", lambda: result_cache.store.total_bytes))
+        metrics.add(Gauge("apitools_result_cache_requests_total", "Result cache lookups by outcome.", lambda: { ("hit",): result_cache.hits, ("miss",): result_cache.misses, ("coalesced",): result_cache.coalesced }, ("outcome",), kind="counter"))
+
+    @routes.get('/api_metrics')
+    async def api_metrics(request):
+        return web.Response(body=metrics.render().encode("utf-8"), headers={ "Content-Type": "text/plain; version=0.0.4; charset=utf-8" })
+
+    @routes.post('/api_invalidate')
+    async def api_invalidate(request):
+        # For when something the definitions depend on has changed, like the models available to loaders
+        node_definitions.invalidate()
+        endpoint_registry.invalidate()
+        return web.json_response({ "ok": True })
+
+    @routes.get('/api_stats')
+    async def api_stats(request):
+        return web.json_response({
+            "endpoint_cache": endpoint_registry.stats(),
+            "node_defs": node_definitions.stats(),
+            "result_cache": result_cache.stats() if result_cache is not None else None,
+            "batching": batch_scheduler.stats() if batch_scheduler is not None else None,
+            "admission": admission.stats(),
+            "prompts": channel.stats(),
+            "jobs": job_store.stats(),
+            "profiles": profiler.stats(),
+            "recorder": recorder.stats() if recorder is not None else None,
+        })
 
-        instantiated = instantiate_from_save(node_defs, graph)
-        return instantiated
-
-    async def api_endpoint(endpoint_name, endpoints_path, body):
-        prompt = await api_getprompt(endpoint_name, endpoints_path, body)
-        client_id = str(uuid.uuid4())
-        prompt["client_id"] = client_id
-        async with aiohttp.ClientSession() as session:
-            async with session.ws_connect("{}/ws?clientId={}".format(get_ws_address(), client_id)) as ws:
-                async with session.post(get_address() + '/prompt', json=prompt) as resp:
-                    try:
-                        response = await resp.json()
-                        prompt_id = response["prompt_id"]
-                    except Exception as e:
-                        print("Error:", e)
-                        raise web.HTTPInternalServerError(reason=e)
-                async for msg in ws:
-                    if msg.type == aiohttp.WSMsgType.TEXT:
-                        message = msg.json()
-                        if message["type"] == "executing":
-                            data = message["data"]
-                            if data["node"] is None and data["prompt_id"] == prompt_id:
-                                break
-                async with session.get(get_address() + '/history/' + prompt_id) as resp:
-                    response = await resp.json()
-                    result = {}
-                    ui_outputs = response[prompt_id]["outputs"]
-                    for node_id in ui_outputs:
-                        if "api_output" in ui_outputs[node_id]:
-                            for x in ui_outputs[node_id]["api_output"]:
-                                result = merge_dict_recursive(result, x)
-                    if len(result) == 1 and "RETURN_PNG" in result:
-                        base64_image = result["RETURN_PNG"][0]
-                        image_bytes = base64.b64decode(base64_image)
-                        return web.Response(body=image_bytes, content_type="image/png")
-                    return web.json_response(result)
+    @routes.get('/api_profile/{prompt_id}')
+    async def api_profile(request):
+        profile = profiler.get(request.match_info["prompt_id"])
+        if profile is None:
+            raise web.HTTPNotFound(reason="No profile for this prompt.")
+        if request.rel_url.query.get("format") == "pstats":
+            if profile.dump_path is None:
+                raise web.HTTPNotFound(reason="This prompt has no cProfile.")
+            return web.FileResponse(profile.dump_path, headers={ "Content-Disposition": 'attachment; filename="{}.prof"'.format(profile.prompt_id) })
+        return web.json_response(profile.describe())
 
     @routes.get('/api_prompt/{endpoint_name}')
     async def api_get_prompt(request):
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import uuid
+
+from .builder import is_link
+from .channel import PromptExecutionError, PromptValidationError
+
+# Node classes that give the same result for the same inputs and are worth running once for a whole
+# batch. Anything else, including custom nodes that add noise or crop at random, runs once per request.
+SHARED_NODES = frozenset([
+    # Loaders
+    "CheckpointLoaderSimple", "CheckpointLoader", "unCLIPCheckpointLoader", "ImageOnlyCheckpointLoader",
+    "VAELoader", "LoraLoader", "LoraLoaderModelOnly", "CLIPLoader", "DualCLIPLoader", "UNETLoader",
+    "ControlNetLoader", "DiffControlNetLoader", "CLIPVisionLoader", "StyleModelLoader", "GLIGENLoader",
+    "HypernetworkLoader", "UpscaleModelLoader", "LoadImage", "LoadImageMask",
+    # Encoders
+    "CLIPSetLastLayer", "CLIPTextEncode", "CLIPVisionEncode", "VAEEncode", "VAEEncodeForInpaint",
+    # Values taken from the request
+    "Input (API)",
+])
+
+def topological_order(prompt):
+    # Inputs before the nodes that use them, so a node's links are remapped before it's compared
+    order = []
+    visited = set()
+    for root in prompt:
+        stack = [(root, False)]
+        while len(stack) > 0:
+            node_id, expanded = stack.pop()
+            if expanded:
+                order.append(node_id)
+                continue
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+            stack.append((node_id, True))
+            for value in prompt[node_id]["inputs"].values():
+                if is_link(value) and value[0] in prompt and value[0] not in visited:
+                    stack.append((value[0], False))
+    return order
+
+def own_node_ids(id_map, merged_id):
+    # The ids a request's own nodes had before they were merged into merged_id
+    return [node_id for node_id, mapped_id in id_map.items() if mapped_id == merged_id]
+
+def merge_prompts(prompts, shareable):
+    """
+    Merges several prompts into one. Nodes with the same class and the same inputs (after their
+    links are remapped) are only included once, so e.g. a checkpoint loader or negative prompt that
+    every request uses runs once for all of them. Only nodes that shareable(node) accepts are shared,
+    the rest are always kept separate. Returns the merged prompt and, for each prompt, a map from its node ids to the
+    ids in the merged prompt.
+    """
+    merged = {}
+    signatures = {}
+    id_maps = []
+    for prompt in prompts:
+        id_map = {}
+        for node_id in topological_order(prompt):
+            node = prompt[node_id]
+            inputs = {}
+            for key, value in node["inputs"].items():
+                if is_link(value) and value[0] in id_map:
+                    value = [id_map[value[0]], value[1]]
+                inputs[key] = value
+
+            signature = None
+            if shareable(node):
+                signature = json.dumps([node["class_type"], inputs], sort_keys=True)
+                if signature in signatures:
+                    id_map[node_id] = signatures[signature]
+                    continue
+
+            # Fresh numeric ids, as some parts of ComfyUI expect them
+            new_id = str(len(merged) + 1)
+            merged[new_id] = { "class_type": node["class_type"], "inputs": inputs }
+            id_map[node_id] = new_id
+            if signature is not None:
+                signatures[signature] = new_id
+        id_maps.append(id_map)
+    return merged, id_maps
+
+class PendingBatch:
+    def __init__(self):
+        self.entries = []
+        self.timer = None
+
+class BatchScheduler:
+    """
+    Holds requests for a short window and submits the ones that share a key as a single prompt.
+    run(prompt, prompt_id, listener) submits a prompt and returns its UI outputs by node id, which
+    are split back up so each request only gets the outputs of its own nodes. Progress events for
+    the batch go to the listener of every request in it.
+
+    A request can pass a ready future that's done once its own outputs have been delivered some
+    other way. It then finishes as soon as that happens, with no UI outputs, instead of waiting
+    for the rest of the batch, and gets no further events.
+
+    validate(prompt) raises PromptValidationError for a request's own prompt before it's merged, so
+    an invalid request fails on its own. If the merged prompt fails, the requests whose nodes the
+    error was in get it (with their own node ids), and the rest are run again one by one.
+    """
+    def __init__(self, window, max_size, run, validate, shareable):
+        self.window = window
+        self.max_size = max_size
+        self.run = run
+        self.validate = validate
+        self.shareable = shareable
+        self.pending = {}
+        self.batches = 0
+        self.batched_requests = 0
+        self.invalid = 0
+        self.resubmitted = 0
+
+    async def submit(self, key, prompt, output_nodes, listener=None, ready=None):
+        loop = asyncio.get_running_loop()
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = PendingBatch()
+            self.pending[key] = batch
+            batch.timer = loop.call_later(self.window, self.flush, key)
+        future = loop.create_future()
+        batch.entries.append((prompt, output_nodes, future, listener, ready))
+        if len(batch.entries) >= self.max_size:
+            batch.timer.cancel()
+            self.flush(key)
+        return await future
+
+    def flush(self, key):
+        batch = self.pending.pop(key, None)
+        if batch is not None:
+            asyncio.ensure_future(self.execute(batch.entries))
+
+    async def execute(self, entries):
+        # Requests that went away while waiting for the window don't need to run
+        entries = [entry for entry in entries if not entry[2].done()]
+        if len(entries) > 1:
+            # A request on its own is validated when it's submitted
+            valid = []
+            for entry in entries:
+                try:
+                    self.validate(entry[0])
+                except PromptValidationError as e:
+                    self.invalid += 1
+                    entry[2].set_exception(e)
+                    continue
+                valid.append(entry)
+            entries = valid
+        if len(entries) == 0:
+            return
+        self.batches += 1
+        self.batched_requests += len(entries)
+        if len(entries) == 1:
+            await self.run_alone(entries[0])
+            return
+        prompt, id_maps = merge_prompts([entry[0] for entry in entries], self.shareable)
+
+        listening = [entry for entry in entries if entry[3] is not None]
+        def listener(event, data):
+            for entry in listening:
+                # Requests that already have their results are done with the batch
+                if not entry[2].done():
+                    entry[3](event, data)
+
+        prompt_id = str(uuid.uuid4())
+        task = asyncio.ensure_future(self.run(prompt, prompt_id, listener if len(listening) > 0 else None))
+        # Once every request in the batch has gone away or has its results, and at least one of
+        # them went away, the rest of the prompt doesn't need to finish
+        def cancel_if_abandoned(future):
+            if all(entry[2].done() for entry in entries) and any(entry[2].cancelled() for entry in entries):
+                task.cancel()
+        for entry in entries:
+            entry[2].add_done_callback(cancel_if_abandoned)
+            if entry[4] is not None:
+                entry[4].add_done_callback(lambda ready, entry=entry: self.finish_early(entry, prompt_id))
+
+        try:
+            outputs = await task
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            await self.recover(entries, id_maps, e)
+            return
+
+        for (_, output_nodes, future, _, _), id_map in zip(entries, id_maps):
+            if future.done():
+                continue
+            own_outputs = {}
+            for node_id in output_nodes:
+                if id_map[node_id] in outputs:
+                    own_outputs[node_id] = outputs[id_map[node_id]]
+            future.set_result(own_outputs)
+
+    def finish_early(self, entry, prompt_id):
+        _, _, future, listener, ready = entry
+        if future.done() or ready.cancelled():
+            return
+        # As far as this request is concerned, the prompt has finished
+        if listener is not None:
+            listener("executing", { "node": None, "prompt_id": prompt_id })
+        future.set_result({})
+
+    async def recover(self, entries, id_maps, e):
+        """
+        Hands the error from a merged prompt to the requests it belongs to, and runs the rest again
+        on their own.
+        """
+        if isinstance(e, PromptExecutionError) and e.interrupted:
+            # Somebody stopped the batch on purpose, so none of it runs again
+            for entry in entries:
+                if not entry[2].done():
+                    entry[2].set_exception(e)
+            return
+
+        remaining = []
+        for entry, id_map in zip(entries, id_maps):
+            error = None
+            if isinstance(e, PromptValidationError):
+                node_errors = {}
+                for merged_id, node_error in (e.node_errors or {}).items():
+                    for node_id in own_node_ids(id_map, merged_id):
+                        node_errors[node_id] = node_error
+                if len(node_errors) > 0:
+                    error = PromptValidationError(e.error, node_errors)
+            elif isinstance(e, PromptExecutionError):
+                node_ids = own_node_ids(id_map, e.data.get("node_id"))
+                if len(node_ids) > 0:
+                    error = PromptExecutionError(dict(e.data, node_id=node_ids[0]))
+            if entry[2].done():
+                continue
+            if error is None:
+                remaining.append(entry)
+            else:
+                entry[2].set_exception(error)
+
+        self.resubmitted += len(remaining)
+        await asyncio.gather(*[self.run_alone(entry) for entry in remaining])
+
+    async def run_alone(self, entry):
+        prompt, output_nodes, future, listener, _ = entry
+        if future.done():
+            return
+        task = asyncio.ensure_future(self.run(prompt, str(uuid.uuid4()), listener))
+        future.add_done_callback(lambda done: task.cancel() if done.cancelled() else None)
+        try:
+            outputs = await task
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result({node_id: outputs[node_id] for node_id in output_nodes if node_id in outputs})
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.batched_requests,
+            "invalid": self.invalid,
+            "resubmitted": self.resubmitted,
+        }
@@ -0,0 +1,241 @@
+"""
+Benchmarks of the API layer on a CPU, run against the stand-in ComfyUI in fake_comfy.py:
+instantiate_from_save and compiling endpoints (for the sdapi workflows and for synthetic graphs
+of thousands of nodes), resolve_request, reading and storing paths, serialize_image and
+deserialize_image, and requests end to end over HTTP at several concurrencies.
+
+    python benchmarks/bench_api.py [--quick] [--output results.json] [--compare baseline.json]
+
+Results are written as JSON so runs on different commits can be compared with --compare.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import timeit
+import aiohttp
+import torch
+from aiohttp.test_utils import TestServer
+
+import fake_comfy
+from bench_paths import leaf_paths, workflow_paths
+
+ROOT = fake_comfy.ROOT
+
+TXT2IMG_BODY = {
+    "prompt": "a lighthouse on a cliff at sunset",
+    "negative_prompt": "blurry",
+    "steps": 20,
+    "width": 512,
+    "height": 512,
+    "seed": 1,
+}
+
+def synthetic_graph(size):
+    """
+    A workflow in the editor's save format with about size nodes: Input (API) nodes each feeding a
+    chain of Serialize (API) nodes that ends in one API Output, with every tenth input going
+    through a Switch (API). Returns the graph and a body that provides every input.
+    """
+    nodes = []
+    links = []
+    body = { "values": {}, "flags": {} }
+
+    def add_node(node_type, inputs, widgets_values):
+        nodes.append({
+            "id": len(nodes) + 1,
+            "type": node_type,
+            "inputs": [{ "name": name, "type": "*", "link": None } for name in inputs],
+            "widgets_values": widgets_values,
+        })
+        return len(nodes)
+
+    def link(from_id, to_id, input_name):
+        inputs = nodes[to_id - 1]["inputs"]
+        slot = [input["name"] for input in inputs].index(input_name)
+        links.append([len(links) + 1, from_id, 0, to_id, slot, "*"])
+        inputs[slot]["link"] = len(links)
+
+    previous = None
+    i = 0
+    while len(nodes) < size - 1:
+        value = add_node("Input (API)", ["default_input"], ["values.v{}".format(i), "integer", "0"])
+        body["values"]["v{}".format(i)] = i
+        if i % 10 == 0:
+            switch = add_node("Switch (API)", ["on_false", "on_true"], ["flags.f{}".format(i), False])
+            link(value, switch, "on_true")
+            body["flags"]["f{}".format(i)] = True
+            value = switch
+        serialize = add_node("Serialize (API)", ["value", "json_object_optional"], ["out.v{}".format(i), "png", 95, 4])
+        link(value, serialize, "value")
+        if previous is not None:
+            link(previous, serialize, "json_object_optional")
+        previous = serialize
+        i += 1
+    output = add_node("API Output", ["json_object", "extra_object2", "extra_object3", "extra_object4", "extra_object5"], [])
+    link(previous, output, "json_object")
+    return { "nodes": nodes, "links": links }, body
+
+def bench(results, name, function, number=1, repeat=5):
+    times = [t / number for t in timeit.repeat(function, number=number, repeat=repeat)]
+    results[name] = {
+        "ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "runs": number * repeat,
+    }
+    print("{:<48} {:>10.3f} ms median {:>10.3f} ms min".format(name, results[name]["ms"], results[name]["min_ms"]))
+
+def load_workflow(name):
+    with open(os.path.join(ROOT, "sdapi", name + ".json"), "r") as f:
+        return json.load(f)
+
+def bench_compile(results, api_server, node_defs, quick):
+    for name in ("txt2img", "img2img"):
+        graph = load_workflow(name)
+        bench(results, "instantiate_from_save/" + name, lambda: api_server.instantiate_from_save(node_defs, graph), 20)
+        bench(results, "compile/" + name, lambda: api_server.CompiledEndpoint(api_server.instantiate_from_save(node_defs, graph), node_defs, name, 0).variant_for(TXT2IMG_BODY), 20)
+    for size in (1000,) if quick else (1000, 5000, 10000):
+        graph, body = synthetic_graph(size)
+        bench(results, "instantiate_from_save/synthetic_{}".format(size), lambda: api_server.instantiate_from_save(node_defs, graph), 1, 3)
+        bench(results, "compile/synthetic_{}".format(size), lambda: api_server.CompiledEndpoint(api_server.instantiate_from_save(node_defs, graph), node_defs, "synthetic", 0).variant_for(body), 1, 3)
+
+def bench_resolve(results, api_server, node_defs, quick):
+    endpoint = api_server.CompiledEndpoint(api_server.instantiate_from_save(node_defs, load_workflow("txt2img")), node_defs, "txt2img", 0)
+    bench(results, "resolve_request/txt2img", lambda: api_server.resolve_request(endpoint.variant_for(TXT2IMG_BODY), TXT2IMG_BODY), 1000)
+    size = 1000 if quick else 10000
+    graph, body = synthetic_graph(size)
+    endpoint = api_server.CompiledEndpoint(api_server.instantiate_from_save(node_defs, graph), node_defs, "synthetic", 0)
+    bench(results, "resolve_request/synthetic_{}".format(size), lambda: api_server.resolve_request(endpoint.variant_for(body), body), 10)
+
+def bench_paths(results, api, api_server):
+    all_paths = workflow_paths()
+    read_paths = [p for p in all_paths if "[]" not in p]
+    store_paths = leaf_paths(all_paths)
+    body = {}
+    for i, path in enumerate(store_paths):
+        api.store_at_position(body, i, path)
+
+    def store():
+        obj = {}
+        for path in store_paths:
+            api.store_at_position(obj, 1, path)
+    bench(results, "store_at_position/sdapi_paths", store, 1000)
+    bench(results, "read_at_position/sdapi_paths", lambda: [api_server.read_at_position(body, p) for p in read_paths], 1000)
+
+def bench_images(results, images, quick):
+    for batch_size in (1,) if quick else (1, 4):
+        for resolution in (512,) if quick else (512, 1024):
+            batch = torch.rand(batch_size, resolution, resolution, 3)
+            label = "{}x{}x{}".format(batch_size, resolution, resolution)
+            bench(results, "serialize_image/" + label, lambda: images.serialize_image(batch), 1, 3)
+            encoded = images.serialize_image(batch)
+            bench(results, "deserialize_image/" + label, lambda: images.deserialize_image(encoded), 1, 3)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def bench_requests(results, app, quick):
+    server = TestServer(app)
+    await server.start_server()
+    body = dict(TXT2IMG_BODY, width=64, height=64, steps=1)
+    try:
+        for concurrency in (1, 8) if quick else (1, 8, 32):
+            count = max(32, concurrency * 4)
+            latencies = []
+            errors = 0
+            pending = list(range(count))
+            connector = aiohttp.TCPConnector(limit=concurrency)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                async def client():
+                    nonlocal errors
+                    while len(pending) > 0:
+                        pending.pop()
+                        start = time.perf_counter()
+                        async with session.post(server.make_url("/sdapi/v1/txt2img"), json=body) as response:
+                            await response.read()
+                            if response.status != 200:
+                                errors += 1
+                        latencies.append(time.perf_counter() - start)
+                # One request first, so compiling the endpoint isn't counted
+                async with session.post(server.make_url("/sdapi/v1/txt2img"), json=body) as response:
+                    await response.read()
+                start = time.perf_counter()
+                await asyncio.gather(*[client() for _ in range(concurrency)])
+                elapsed = time.perf_counter() - start
+            name = "requests/txt2img_concurrency_{}".format(concurrency)
+            results[name] = {
+                "ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "requests_per_second": count / elapsed,
+                "errors": errors,
+                "runs": count,
+            }
+            print("{:<48} {:>10.3f} ms p50 {:>10.3f} ms p95 {:>8.1f} req/s {} errors".format(name, results[name]["ms"], results[name]["p95_ms"], results[name]["requests_per_second"], errors))
+    finally:
+        await server.close()
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout.strip() != ""
+    except OSError:
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.time(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    print("\nCompared to {} (commit {}), lower is better:".format(baseline_path, baseline["environment"].get("commit")))
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is not None:
+            print("{:<48} {:>10.3f} ms -> {:>10.3f} ms {:>7.2f}x".format(name, before["ms"], result["ms"], result["ms"] / before["ms"]))
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="Only the smaller sizes, for a fast check.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare the results with those in this JSON file.")
+    parser.add_argument("--image-size", type=int, default=512, help="Size of the images the fake executor produces.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as base_path:
+        server, package = await fake_comfy.start(base_path, args.image_size)
+        api = importlib.import_module(fake_comfy.PACKAGE + ".api")
+        api_server = importlib.import_module(fake_comfy.PACKAGE + ".api_server")
+        images = importlib.import_module(fake_comfy.PACKAGE + ".images")
+        node_defs_module = importlib.import_module(fake_comfy.PACKAGE + ".node_defs")
+        version, node_defs = await node_defs_module.node_definitions.get()
+
+        results = {}
+        bench_compile(results, api_server, node_defs, args.quick)
+        bench_resolve(results, api_server, node_defs, args.quick)
+        bench_paths(results, api, api_server)
+        bench_images(results, images, args.quick)
+        await bench_requests(results, server.app, args.quick)
+
+    output = { "environment": environment(), "results": results }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare is not None:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,149 @@
+"""
+Micro-benchmark comparing compiled paths (paths.py) against the original regex-splitting
+read_at_position/store_at_position, using the paths found in the bundled sdapi workflows.
+
+    python benchmarks/bench_paths.py
+"""
+import glob
+import importlib.util
+import json
+import os
+import re
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location("paths", os.path.join(ROOT, "paths.py"))
+paths = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(paths)
+
+# The implementations paths.py replaced, kept here as the baseline
+def legacy_read_at_position(obj, path):
+    try:
+        path = re.split('[\.\[]', path)
+        current = obj
+        for i in range(len(path)):
+            if path[i][-1] == "]":
+                assert isinstance(current, list)
+                key = int(path[i][:-1])
+                current = current[key]
+            else:
+                current = current[path[i]]
+        return current
+    except:
+        return None
+
+def legacy_store_at_position(obj, result, path):
+    path = re.split('[\.\[]', path)
+    current = obj
+    for i in range(len(path) - 1):
+        next_is_list = path[i + 1][-1] == "]"
+        if path[i] == "]":
+            assert isinstance(current, list)
+            if next_is_list:
+                current.append([])
+            else:
+                current.append({})
+            current = current[-1]
+        elif path[i][-1] == "]":
+            assert isinstance(current, list)
+            key = int(path[i][:-1])
+            if key == -1 and len(current) == 0:
+                key = 0
+            if key >= len(current):
+                current += [None] * (key - len(current) + 1)
+            if current[key] is None:
+                if next_is_list:
+                    current[key] = []
+                else:
+                    current[key] = {}
+            current = current[key]
+        elif path[i] not in current:
+            key = path[i]
+            if next_is_list:
+                current[key] = []
+            else:
+                current[key] = {}
+            current = current[key]
+        else:
+            current = current[path[i]]
+
+    last = path[-1]
+    if last == "]":
+        current.append(result)
+    elif last[-1] == "]":
+        key = int(last[:-1])
+        if key >= len(current):
+            current += [None] * (key - len(current) + 1)
+        current[key] = result
+    else:
+        current[last] = result
+
+PATH_NODES = ("Input (API)", "Random Seed Input (API)", "Switch (API)", "Value Switch (API)", "Serialize (API)")
+
+def workflow_paths():
+    found = set()
+    for filename in glob.glob(os.path.join(ROOT, "sdapi", "*.json")):
+        # Warm-up request bodies sit next to the workflows
+        if filename.endswith(".warmup.json"):
+            continue
+        with open(filename, "r") as f:
+            graph = json.load(f)
+        for node in graph["nodes"]:
+            if node["type"] in PATH_NODES and node.get("widgets_values"):
+                path = node["widgets_values"][0]
+                if isinstance(path, str) and path != "":
+                    found.add(path)
+    return sorted(found)
+
+def leaf_paths(all_paths):
+    # "args[0]" is only a prefix of "args[0].model", so storing both would conflict
+    return [p for p in all_paths if not any(other != p and other.startswith(p) for other in all_paths)]
+
+def build_body(read_paths):
+    body = {}
+    for i, path in enumerate(leaf_paths(read_paths)):
+        legacy_store_at_position(body, i, path)
+    return body
+
+def bench(label, function, number):
+    seconds = min(timeit.repeat(function, number=number, repeat=5))
+    print("{:<28} {:>10.3f} us/pass".format(label, seconds / number * 1e6))
+    return seconds
+
+def main():
+    all_paths = workflow_paths()
+    read_paths = [p for p in all_paths if "[]" not in p]
+    body = build_body(read_paths)
+    compiled = [paths.compile_path(p) for p in read_paths]
+
+    for path, steps in zip(read_paths, compiled):
+        assert legacy_read_at_position(body, path) == paths.get_path(body, steps), path
+    store_paths = leaf_paths(all_paths)
+    for path in store_paths:
+        expected, actual = {}, {}
+        legacy_store_at_position(expected, 1, path)
+        paths.set_path(actual, paths.compile_path(path), 1)
+        assert expected == actual, path
+
+    number = 2000
+    print("{} paths ({} readable) from sdapi/*.json, per-pass timings".format(len(all_paths), len(read_paths)))
+    legacy = bench("legacy read_at_position", lambda: [legacy_read_at_position(body, p) for p in read_paths], number)
+    cached = bench("get_path (compile cached)", lambda: [paths.get_path(body, paths.compile_path(p)) for p in read_paths], number)
+    precompiled = bench("get_path (precompiled)", lambda: [paths.get_path(body, s) for s in compiled], number)
+    print("  speedup: {:.1f}x cached, {:.1f}x precompiled".format(legacy / cached, legacy / precompiled))
+
+    def legacy_store():
+        obj = {}
+        for p in store_paths:
+            legacy_store_at_position(obj, 1, p)
+    def compiled_store():
+        obj = {}
+        for p in store_paths:
+            paths.set_path(obj, paths.compile_path(p), 1)
+    legacy = bench("legacy store_at_position", legacy_store, number)
+    cached = bench("set_path (compile cached)", compiled_store, number)
+    print("  speedup: {:.1f}x".format(legacy / cached))
+
+if __name__ == "__main__":
+    main()
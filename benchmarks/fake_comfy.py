@@ -0,0 +1,216 @@
+"""
+A stand-in for the parts of ComfyUI the API layer uses -- server.PromptServer, folder_paths, nodes
+and execution -- so api.py and api_server.py can be run on a CPU without ComfyUI or a GPU. Node
+definitions for everything but this package's own nodes come from object_info.json, which has
+what /object_info reports for the nodes the bundled sdapi workflows use.
+
+Prompts are run by FakeExecutor on a worker thread, the way ComfyUI's prompt worker runs them. The
+API nodes run for real; every other node returns placeholders (a fixed random image for IMAGE
+outputs), optionally sleeping in KSampler to stand in for GPU time.
+
+    server, package = await fake_comfy.start(base_path)
+"""
+import asyncio
+import heapq
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import types
+import torch
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OBJECT_INFO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "object_info.json")
+# ComfyUI imports custom nodes as a package named after their folder
+PACKAGE = "apitools"
+
+class PromptQueue:
+    """
+    The same interface as ComfyUI's PromptQueue: a heap of (number, prompt_id, prompt, extra_data,
+    outputs) items, the prompts being run and the history, all behind one mutex.
+    """
+    def __init__(self):
+        self.mutex = threading.RLock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.queue = []
+        self.currently_running = {}
+        self.history = {}
+        self.task_counter = 0
+
+    def put(self, item):
+        with self.mutex:
+            heapq.heappush(self.queue, item)
+            self.not_empty.notify()
+
+    def get(self):
+        with self.not_empty:
+            while len(self.queue) == 0:
+                self.not_empty.wait()
+            item = heapq.heappop(self.queue)
+            item_id = self.task_counter
+            self.currently_running[item_id] = item
+            self.task_counter += 1
+            return item, item_id
+
+    def task_done(self, item_id, outputs):
+        with self.mutex:
+            item = self.currently_running.pop(item_id)
+            self.history[item[1]] = { "prompt": item, "outputs": outputs }
+
+    def delete_queue_item(self, function):
+        with self.mutex:
+            for i, item in enumerate(self.queue):
+                if function(item):
+                    self.queue.pop(i)
+                    heapq.heapify(self.queue)
+                    return True
+        return False
+
+def placeholder_class(name, info):
+    def INPUT_TYPES(cls):
+        return info["input"]
+    return type(name, (), {
+        "INPUT_TYPES": classmethod(INPUT_TYPES),
+        "RETURN_TYPES": tuple(info["output"]),
+        "RETURN_NAMES": tuple(info["output_name"]),
+        "OUTPUT_NODE": info["output_node"],
+        "CATEGORY": info["category"],
+        "FUNCTION": "run",
+        "PLACEHOLDER": True,
+    })
+
+def placeholder_classes():
+    with open(OBJECT_INFO, "r") as f:
+        object_info = json.load(f)
+    return {name: placeholder_class(name, info) for name, info in object_info.items()}
+
+class FakeExecutor:
+    """
+    Runs prompts in place of ComfyUI's executor, sending the same events through send_sync.
+    """
+    def __init__(self, server, image_size=512, sampler_seconds=0.0):
+        self.server = server
+        self.sampler_seconds = sampler_seconds
+        self.image = torch.rand(1, image_size, image_size, 3)
+        self.interrupted = False
+
+    def placeholder(self, output_type):
+        if output_type == "IMAGE":
+            return self.image
+        elif output_type == "INT":
+            return 0
+        elif output_type == "FLOAT":
+            return 0.0
+        elif output_type == "STRING":
+            return ""
+        return None
+
+    def execute(self, prompt_id, prompt):
+        nodes = sys.modules["nodes"]
+        batching = importlib.import_module(PACKAGE + ".batching")
+        is_link = importlib.import_module(PACKAGE + ".builder").is_link
+        sid = self.server.client_id
+        results = {}
+        ui_outputs = {}
+        self.interrupted = False
+        for node_id in batching.topological_order(prompt):
+            if self.interrupted:
+                self.server.send_sync("execution_interrupted", { "prompt_id": prompt_id, "node_id": node_id }, sid)
+                break
+            node = prompt[node_id]
+            node_class = nodes.NODE_CLASS_MAPPINGS[node["class_type"]]
+            inputs = {name: results[value[0]][value[1]] if is_link(value) else value for name, value in node["inputs"].items()}
+            self.server.send_sync("executing", { "node": node_id, "prompt_id": prompt_id }, sid)
+            try:
+                if getattr(node_class, "PLACEHOLDER", False):
+                    if node["class_type"] == "KSampler" and self.sampler_seconds > 0:
+                        time.sleep(self.sampler_seconds)
+                    output = tuple(self.placeholder(output_type) for output_type in node_class.RETURN_TYPES)
+                else:
+                    output = getattr(node_class(), node_class.FUNCTION)(**inputs)
+            except Exception as e:
+                self.server.send_sync("execution_error", { "prompt_id": prompt_id, "node_id": node_id, "exception_message": str(e), "exception_type": type(e).__name__ }, sid)
+                break
+            if isinstance(output, dict):
+                if "ui" in output:
+                    ui_outputs[node_id] = output["ui"]
+                output = output.get("result", ())
+            results[node_id] = output
+        return ui_outputs
+
+class FakePromptServer:
+    def __init__(self, loop, image_size=512, sampler_seconds=0.0):
+        self.loop = loop
+        self.routes = web.RouteTableDef()
+        # The same limit ComfyUI sets, for large base64 bodies
+        self.app = web.Application(client_max_size=1024 ** 3)
+        self.number = 0
+        self.client_id = None
+        self.prompt_queue = PromptQueue()
+        self.executor = FakeExecutor(self, image_size, sampler_seconds)
+
+    def send_sync(self, event, data, sid=None):
+        # Nobody is connected, the API layer hooks this to follow its prompts
+        pass
+
+    def worker(self):
+        while True:
+            item, item_id = self.prompt_queue.get()
+            number, prompt_id, prompt, extra_data, outputs = item
+            self.send_sync("execution_start", { "prompt_id": prompt_id }, self.client_id)
+            ui_outputs = self.executor.execute(prompt_id, prompt)
+            self.prompt_queue.task_done(item_id, ui_outputs)
+            self.send_sync("executing", { "node": None, "prompt_id": prompt_id }, self.client_id)
+
+def validate_prompt(prompt):
+    # Returns (valid, error, output node ids, node errors) like ComfyUI's
+    nodes = sys.modules["nodes"]
+    for node_id, node in prompt.items():
+        if node["class_type"] not in nodes.NODE_CLASS_MAPPINGS:
+            return (False, { "type": "invalid_prompt", "message": "Cannot execute because node {} does not exist.".format(node["class_type"]), "details": node_id, "extra_info": {} }, [], {})
+    outputs = [node_id for node_id, node in prompt.items() if getattr(nodes.NODE_CLASS_MAPPINGS[node["class_type"]], "OUTPUT_NODE", False)]
+    if len(outputs) == 0:
+        return (False, { "type": "prompt_no_outputs", "message": "Prompt has no outputs", "details": "", "extra_info": {} }, [], {})
+    return (True, None, outputs, {})
+
+def install_modules(server, base_path):
+    server_module = types.ModuleType("server")
+    server_module.PromptServer = type("PromptServer", (), { "instance": server })
+    folder_paths = types.ModuleType("folder_paths")
+    folder_paths.base_path = base_path
+    nodes = types.ModuleType("nodes")
+    nodes.NODE_CLASS_MAPPINGS = placeholder_classes()
+    nodes.NODE_DISPLAY_NAME_MAPPINGS = {}
+    def interrupt_processing(value=True):
+        server.executor.interrupted = value
+    nodes.interrupt_processing = interrupt_processing
+    execution = types.ModuleType("execution")
+    execution.validate_prompt = validate_prompt
+    for module in (server_module, folder_paths, nodes, execution):
+        sys.modules[module.__name__] = module
+
+def load_package():
+    # Importing the package registers its routes, as it does when ComfyUI loads it
+    spec = importlib.util.spec_from_file_location(PACKAGE, os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE] = package
+    spec.loader.exec_module(package)
+    return package
+
+async def start(base_path, image_size=512, sampler_seconds=0.0):
+    """
+    Loads the package against a fake server and starts running prompts. base_path stands in for
+    the ComfyUI folder, for the endpoints folder and anything the API layer keeps on disk.
+    Returns the server, whose app has the API routes, and the package.
+    """
+    server = FakePromptServer(asyncio.get_running_loop(), image_size, sampler_seconds)
+    install_modules(server, base_path)
+    package = load_package()
+    sys.modules["nodes"].NODE_CLASS_MAPPINGS.update(package.NODE_CLASS_MAPPINGS)
+    server.app.add_routes(server.routes)
+    threading.Thread(target=server.worker, daemon=True, name="fake-prompt-worker").start()
+    return server, package
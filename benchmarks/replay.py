@@ -0,0 +1,227 @@
+"""
+Replays a request log recorded with APITOOLS_RECORD_REQUESTS against a server, at a fixed
+concurrency or at a target rate, and reports latency percentiles, throughput and error rates.
+
+    python benchmarks/replay.py requests.jsonl --url http://127.0.0.1:8188 --concurrency 8
+    python benchmarks/replay.py requests.jsonl --url http://127.0.0.1:8188 --qps 20 --duration 60
+    python benchmarks/replay.py requests.jsonl --fake --concurrency 32
+
+With --fake the requests go to the stand-in ComfyUI in fake_comfy.py instead, which runs the API
+nodes but nothing else, so what's measured is the API layer on its own rather than GPU time
+(--sampler-seconds adds a fixed time per prompt to stand in for sampling). Workflows for /api/
+endpoints are taken from --endpoints in that case.
+
+Images recorded as stubs ("$image:512x512") are sent as random PNGs of that size.
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import io
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import aiohttp
+
+IMAGE_STUB_PREFIX = "$image:"
+
+def load_log(path, paths=None):
+    entries = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line == "":
+                continue
+            entry = json.loads(line)
+            if paths is None or any(entry["path"].startswith(prefix) for prefix in paths):
+                entries.append(entry)
+    return entries
+
+class StubImages:
+    """
+    Random PNGs to send in place of images that weren't recorded, one per size.
+    """
+    def __init__(self):
+        self.images = {}
+
+    def get(self, size):
+        image = self.images.get(size)
+        if image is None:
+            # Only needed for logs with stubs
+            from PIL import Image
+            width, height = (int(x) for x in size.split("x"))
+            f = io.BytesIO()
+            Image.frombytes("RGB", (width, height), os.urandom(width * height * 3)).save(f, format="PNG")
+            image = base64.b64encode(f.getvalue()).decode("utf-8")
+            self.images[size] = image
+        return image
+
+    def expand(self, obj):
+        if isinstance(obj, str) and obj.startswith(IMAGE_STUB_PREFIX):
+            return self.get(obj[len(IMAGE_STUB_PREFIX):])
+        elif isinstance(obj, dict):
+            return {key: self.expand(value) for key, value in obj.items()}
+        elif isinstance(obj, list):
+            return [self.expand(value) for value in obj]
+        return obj
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def summarize(samples, elapsed):
+    latencies = [seconds for path, status, seconds in samples]
+    errors = sum(1 for path, status, seconds in samples if status is None or status >= 400)
+    summary = {
+        "requests": len(samples),
+        "seconds": elapsed,
+        "requests_per_second": len(samples) / elapsed if elapsed > 0 else None,
+        "errors": errors,
+        "error_rate": errors / len(samples) if len(samples) > 0 else None,
+        "statuses": dict(collections.Counter(str(status) for path, status, seconds in samples)),
+    }
+    if len(latencies) > 0:
+        summary.update({
+            "mean_ms": statistics.mean(latencies) * 1000,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies) * 1000,
+        })
+    return summary
+
+def print_summary(name, summary):
+    if summary["requests"] == 0:
+        print("{:<32} no requests".format(name))
+        return
+    print("{:<32} {:>6} requests {:>8.1f} req/s {:>6.1%} errors   p50 {:>9.1f} ms   p95 {:>9.1f} ms   p99 {:>9.1f} ms".format(
+        name, summary["requests"], summary["requests_per_second"], summary["error_rate"], summary["p50_ms"], summary["p95_ms"], summary["p99_ms"]))
+
+async def send(session, url, entry, images, samples):
+    start = time.perf_counter()
+    status = None
+    try:
+        if entry["method"] == "GET":
+            request = session.get(url + entry["path"], params=entry.get("query") or {})
+        else:
+            request = session.post(url + entry["path"], params=entry.get("query") or {}, json=images.expand(entry["body"]))
+        async with request as response:
+            await response.read()
+            status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print("Error sending a request to", entry["path"], e)
+    samples.append((entry["path"], status, time.perf_counter() - start))
+
+async def replay(url, entries, concurrency, qps, count, duration, timeout):
+    """
+    Sends count requests (or as many as fit in duration seconds), cycling through the log. With qps
+    they're started at that rate whether or not earlier ones have finished; otherwise concurrency
+    requests are kept in flight. Returns (path, status, seconds) for each request and the time taken.
+    """
+    images = StubImages()
+    samples = []
+    connector = aiohttp.TCPConnector(limit=0 if qps is not None else concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        # Stub images are generated up front so that isn't timed
+        for entry in entries:
+            images.expand(entry["body"])
+        start = time.perf_counter()
+        deadline = start + duration if duration is not None else None
+
+        def more(sent):
+            if count is not None and sent >= count:
+                return False
+            return deadline is None or time.perf_counter() < deadline
+
+        if qps is not None:
+            tasks = []
+            while more(len(tasks)):
+                delay = start + len(tasks) / qps - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.ensure_future(send(session, url, entries[len(tasks) % len(entries)], images, samples)))
+            await asyncio.gather(*tasks)
+        else:
+            sent = 0
+            async def worker():
+                nonlocal sent
+                while more(sent):
+                    entry = entries[sent % len(entries)]
+                    sent += 1
+                    await send(session, url, entry, images, samples)
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    return samples, elapsed
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="A JSONL request log.")
+    parser.add_argument("--url", default="http://127.0.0.1:8188", help="The server to replay against.")
+    parser.add_argument("--fake", action="store_true", help="Replay against the stand-in ComfyUI, with no GPU work.")
+    parser.add_argument("--endpoints", help="With --fake, a folder of workflows for /api/ endpoints.")
+    parser.add_argument("--sampler-seconds", type=float, default=0.0, help="With --fake, seconds each KSampler takes.")
+    parser.add_argument("--image-size", type=int, default=512, help="With --fake, size of the images the fake executor produces.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests kept in flight.")
+    parser.add_argument("--qps", type=float, help="Start requests at this rate instead of at a fixed concurrency.")
+    parser.add_argument("--count", type=int, help="Requests to send. Defaults to one pass through the log.")
+    parser.add_argument("--duration", type=float, help="Seconds to send requests for, instead of a count.")
+    parser.add_argument("--warmup", type=int, default=1, help="Requests sent before measuring, e.g. so endpoints are compiled.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds before a request counts as failed.")
+    parser.add_argument("--path", action="append", help="Only replay requests to paths starting with this, e.g. /sdapi/v1/txt2img.")
+    parser.add_argument("--output", help="Write the summary to this JSON file.")
+    args = parser.parse_args()
+
+    entries = load_log(args.log, args.path)
+    if len(entries) == 0:
+        parser.error("No requests to replay in " + args.log)
+    count = args.count
+    if count is None and args.duration is None:
+        count = len(entries)
+
+    base_path = None
+    test_server = None
+    url = args.url.rstrip("/")
+    if args.fake:
+        import fake_comfy
+        from aiohttp.test_utils import TestServer
+        base_path = tempfile.mkdtemp()
+        if args.endpoints is not None:
+            shutil.copytree(args.endpoints, os.path.join(base_path, "endpoints"))
+        server, package = await fake_comfy.start(base_path, args.image_size, args.sampler_seconds)
+        test_server = TestServer(server.app)
+        await test_server.start_server()
+        url = str(test_server.make_url("")).rstrip("/")
+
+    try:
+        if args.warmup > 0:
+            await replay(url, entries, 1, None, args.warmup, None, args.timeout)
+        samples, elapsed = await replay(url, entries, args.concurrency, args.qps, count, args.duration, args.timeout)
+    finally:
+        if test_server is not None:
+            await test_server.close()
+        if base_path is not None:
+            shutil.rmtree(base_path, ignore_errors=True)
+
+    results = { "total": summarize(samples, elapsed), "paths": {} }
+    print_summary("total", results["total"])
+    by_path = collections.defaultdict(list)
+    for sample in samples:
+        by_path[sample[0]].append(sample)
+    for path in sorted(by_path):
+        results["paths"][path] = summarize(by_path[path], elapsed)
+        print_summary(path, results["paths"][path])
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({
+                "log": args.log,
+                "url": "fake" if args.fake else url,
+                "concurrency": args.concurrency if args.qps is None else None,
+                "qps": args.qps,
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -30,10 +30,15 @@ def example_usage():
         }
     }
 
+def is_link(value):
+    return isinstance(value, list) and len(value) == 2
+
 class GraphBuilder:
     def __init__(self):
         self.nodes = {}
         self.id_gen = 1
+        # (producer id, output index) -> {(consumer id, input name): None}, an ordered set
+        self.consumers = {}
 
     def node(self, class_type, id=None, **kwargs):
         if id is None:
@@ -42,8 +47,11 @@ class GraphBuilder:
         if id in self.nodes:
             return self.nodes[id]
 
-        node = Node(id, class_type, kwargs)
+        node = Node(id, class_type, kwargs, self)
         self.nodes[id] = node
+        for key, value in kwargs.items():
+            if is_link(value):
+                self.add_link(value, id, key)
         return node
 
     def lookup_node(self, id):
@@ -55,36 +63,84 @@ class GraphBuilder:
             output[node_id] = node.serialize()
         return output
 
+    def add_link(self, link, consumer_id, key):
+        consumers = self.consumers.get((link[0], link[1]))
+        if consumers is None:
+            consumers = {}
+            self.consumers[(link[0], link[1])] = consumers
+        consumers[(consumer_id, key)] = None
+
+    def remove_link(self, link, consumer_id, key):
+        consumers = self.consumers.get((link[0], link[1]))
+        if consumers is not None:
+            consumers.pop((consumer_id, key), None)
+
+    def get_consumers(self, node_id, index):
+        return list(self.consumers.get((node_id, index), ()))
+
     def replace_node_output(self, node_id, index, new_value):
-        to_remove = []
-        for node in self.nodes.values():
-            for key, value in node.inputs.items():
-                if isinstance(value, list) and value[0] == node_id and value[1] == index:
-                    if new_value is None:
-                        to_remove.append((node, key))
-                    else:
-                        node.inputs[key] = new_value
-        for node, key in to_remove:
-            del node.inputs[key]
+        for consumer_id, key in self.get_consumers(node_id, index):
+            consumer = self.nodes.get(consumer_id)
+            if consumer is not None:
+                consumer.set_input(key, new_value)
 
     def remove_node(self, id):
-        del self.nodes[id]
+        node = self.nodes.pop(id)
+        for key, value in node.inputs.items():
+            if is_link(value):
+                self.remove_link(value, id, key)
+
+    def copy(self):
+        result = GraphBuilder()
+        result.id_gen = self.id_gen
+        for node_id, node in self.nodes.items():
+            result.nodes[node_id] = Node(node.id, node.class_type, dict(node.inputs), result)
+        for (producer, index), consumers in self.consumers.items():
+            if len(consumers) > 0:
+                result.consumers[(producer, index)] = dict(consumers)
+        return result
+
+    def prune(self, is_output):
+        """
+        Removes every node that isn't an output node or an (indirect) input to one.
+        """
+        reachable = set()
+        stack = [node_id for node_id, node in self.nodes.items() if is_output(node)]
+        while len(stack) > 0:
+            node_id = stack.pop()
+            if node_id in reachable:
+                continue
+            reachable.add(node_id)
+            for value in self.nodes[node_id].inputs.values():
+                if is_link(value) and value[0] in self.nodes:
+                    stack.append(value[0])
+        for node_id in [node_id for node_id in self.nodes if node_id not in reachable]:
+            self.remove_node(node_id)
 
 class Node:
-    def __init__(self, id, class_type, inputs):
+    __slots__ = ("id", "class_type", "inputs", "graph")
+
+    def __init__(self, id, class_type, inputs, graph=None):
         self.id = id
         self.class_type = class_type
         self.inputs = inputs
+        self.graph = graph
 
     def out(self, index):
         return [self.id, index]
 
     def set_input(self, key, value):
+        # Goes through the graph so its index of links stays up to date
+        old_value = self.inputs.get(key)
+        if self.graph is not None and is_link(old_value):
+            self.graph.remove_link(old_value, self.id, key)
         if value is None:
             if key in self.inputs:
                 del self.inputs[key]
         else:
             self.inputs[key] = value
+            if self.graph is not None and is_link(value):
+                self.graph.add_link(value, self.id, key)
 
     def get_input(self, key):
         return self.inputs.get(key)
@@ -0,0 +1,247 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+
+from .images import EncodedImage
+from .uploads import is_upload, upload_store
+
+def estimate_size(value):
+    if isinstance(value, EncodedImage):
+        return len(value.encode())
+    elif isinstance(value, (str, bytes)):
+        return len(value)
+    elif isinstance(value, dict):
+        return sum(len(key) + estimate_size(item) for key, item in value.items())
+    elif isinstance(value, list):
+        return sum(estimate_size(item) for item in value)
+    return 8
+
+class DiskTier:
+    """
+    Pickled entries in a directory, evicting the least recently used files once the directory
+    grows past max_bytes.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(path) if entry.name.endswith(".pkl"))
+
+    def filename(self, key):
+        return os.path.join(self.path, key + ".pkl")
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, "rb") as f:
+                value = pickle.load(f)
+            os.utime(filename)
+            return value
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            filename = self.filename(key)
+            if os.path.exists(filename):
+                self.total_bytes -= os.path.getsize(filename)
+            with open(filename, "wb") as f:
+                f.write(data)
+            self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def delete(self, key):
+        with self.lock:
+            try:
+                filename = self.filename(key)
+                size = os.path.getsize(filename)
+                os.remove(filename)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+    def evict(self):
+        entries = sorted((entry for entry in os.scandir(self.path) if entry.name.endswith(".pkl")), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+class LRUStore:
+    """
+    An in-memory LRU map bounded by entry count and total size, with an optional expiry time and
+    an optional disk tier that entries are written through to.
+    """
+    def __init__(self, max_entries, max_bytes, ttl=None, disk=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk = disk
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, size, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    return value
+                self.pop_entry(key)
+        if self.disk is not None:
+            # On disk, entries are kept with the wall clock time they expire at
+            entry = self.disk.get(key)
+            if not isinstance(entry, tuple) or len(entry) != 2:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                self.disk.delete(key)
+                return None
+            self.put(key, value, write_through=False, ttl=expires_at - time.time() if expires_at is not None else None)
+            return value
+        return None
+
+    def put(self, key, value, size=None, write_through=True, ttl=None):
+        if size is None:
+            size = estimate_size(value)
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self.pop_entry(key)
+            if size <= self.max_bytes:
+                self.entries[key] = (value, size, expires)
+                self.total_bytes += size
+                while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                    self.pop_entry(next(iter(self.entries)))
+        if write_through and self.disk is not None:
+            self.disk.put(key, (value, time.time() + ttl if ttl is not None else None))
+
+    def pop_entry(self, key):
+        value, size, expires = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.pop_entry(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, (value, size, expires) in self.entries.items() if expires is not None and expires <= now]
+            for key in expired:
+                self.pop_entry(key)
+        return expired
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+        }
+
+# Strings longer than this (base64 images, mostly) are replaced by their digest in cache keys
+DIGEST_STRING_LENGTH = 1024
+
+def canonical_inputs(value):
+    # Upload tokens are random per request, so the cache key uses a digest of the file instead. Long
+    # strings are digested too, which hashlib does without holding the GIL.
+    if is_upload(value):
+        return "upload:" + hashlib.sha256(upload_store.get(value)).hexdigest()
+    elif isinstance(value, str) and len(value) > DIGEST_STRING_LENGTH:
+        return "sha256:" + hashlib.sha256(value.encode("utf-8")).hexdigest()
+    elif isinstance(value, dict):
+        return {key: canonical_inputs(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [canonical_inputs(item) for item in value]
+    return value
+
+class ResultCache:
+    """
+    Caches the merged results of deterministic requests, keyed on a hash of the resolved prompt
+    and the version of the endpoint it came from. Concurrent requests for the same key share a
+    single execution.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def key_for(self, endpoint_path, version, prompt):
+        # Called on the API worker threads, see offload.run_off_loop
+        canonical = json.dumps([endpoint_path, version, canonical_inputs(prompt)], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def run(self, function, *args):
+        # Reading and writing the disk tier is kept off the event loop
+        if self.store.disk is None:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def get_or_compute(self, key, compute):
+        """
+        Returns the result and "HIT" or "MISS". compute is only called if neither the cache nor
+        an execution already in flight can provide the result. Results must have their images
+        encoded already, so the cache holds bytes rather than pixels.
+        """
+        while True:
+            result = await self.run(self.store.get, key)
+            if result is not None:
+                self.hits += 1
+                return result, "HIT"
+
+            inflight = self.inflight.get(key)
+            if inflight is None:
+                break
+            try:
+                result = await asyncio.shield(inflight)
+                self.coalesced += 1
+                return result, "HIT"
+            except asyncio.CancelledError:
+                # If the request doing the work went away, one of the waiting ones takes over
+                if not inflight.cancelled():
+                    raise
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            result = await compute()
+            await self.run(self.store.put, key, result, estimate_size(result))
+            future.set_result(result)
+            return result, "MISS"
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Marks the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self.inflight[key]
+
+    def stats(self):
+        return dict(self.store.stats(), hits=self.hits, misses=self.misses, coalesced=self.coalesced)
@@ -0,0 +1,197 @@
+import time
+import uuid
+import execution
+import nodes
+
+from . import config
+from .profiling import profiler
+
+class PromptValidationError(Exception):
+    def __init__(self, error, node_errors):
+        super().__init__(error.get("message") if isinstance(error, dict) else error)
+        self.error = error
+        self.node_errors = node_errors
+
+class PromptExecutionError(Exception):
+    def __init__(self, data, interrupted=False):
+        super().__init__(data.get("exception_message", "Prompt execution failed"))
+        self.data = data
+        # Stopped on purpose rather than failed
+        self.interrupted = interrupted
+
+class PromptChannel:
+    """
+    Submits prompts straight onto the PromptServer's queue and resolves a future once the
+    executor reports that they have finished. This replaces posting to /prompt and listening on a
+    per-request websocket over loopback.
+    """
+    def __init__(self, server):
+        self.server = server
+        # Messages for this id have no socket to go to, so they aren't broadcast to UI clients
+        self.client_id = "apitools-" + str(uuid.uuid4())
+        self.waiting = {}
+        self.errors = {}
+        self.started = {}
+        # Callbacks that are sent every event for a prompt, as listener(event, data)
+        self.listeners = {}
+        # The prompt that is running, if it's one of ours
+        self.current = None
+        # Interrupted prompts, whose history is cleaned up once they stop
+        self.abandoned = set()
+        # Moving average of how long prompts take to run, to estimate the work saved by cancelling
+        self.average_execution = None
+        self.cancelled_queued = 0
+        self.interrupted = 0
+        self.cancelled_seconds = 0.0
+        self.install()
+
+    def install(self):
+        original_send_sync = self.server.send_sync
+
+        # The executor reports progress through send_sync from its own thread
+        def send_sync(event, data, *args, **kwargs):
+            original_send_sync(event, data, *args, **kwargs)
+            if isinstance(data, dict):
+                if data.get("prompt_id") in self.waiting:
+                    profiler.on_event(event, data)
+                    self.server.loop.call_soon_threadsafe(self.dispatch, event, data)
+                elif event == "progress" and "prompt_id" not in data and self.current in self.listeners:
+                    # Older versions of ComfyUI don't say which prompt progress is for
+                    self.server.loop.call_soon_threadsafe(self.dispatch, event, dict(data, prompt_id=self.current))
+            else:
+                # Binary events (previews) only say which client they're for, and only one prompt runs at a time
+                sid = args[0] if len(args) > 0 else kwargs.get("sid")
+                current = self.current
+                if sid == self.client_id and current in self.listeners:
+                    self.server.loop.call_soon_threadsafe(self.notify, current, event, data)
+
+        self.server.send_sync = send_sync
+
+    def notify(self, prompt_id, event, data):
+        listener = self.listeners.get(prompt_id)
+        if listener is not None:
+            listener(event, data)
+
+    def dispatch(self, event, data):
+        prompt_id = data["prompt_id"]
+        self.notify(prompt_id, event, data)
+        if event == "execution_start":
+            self.started[prompt_id] = time.monotonic()
+            self.current = prompt_id
+        elif event == "execution_error" or event == "execution_interrupted":
+            self.errors[prompt_id] = (event, data)
+        elif event == "executing" and data["node"] is None:
+            future = self.waiting.pop(prompt_id, None)
+            error = self.errors.pop(prompt_id, None)
+            started = self.started.pop(prompt_id, None)
+            self.listeners.pop(prompt_id, None)
+            if self.current == prompt_id:
+                self.current = None
+            if started is not None and error is None:
+                duration = time.monotonic() - started
+                self.average_execution = duration if self.average_execution is None else 0.8 * self.average_execution + 0.2 * duration
+            if prompt_id in self.abandoned:
+                self.abandoned.discard(prompt_id)
+                if not config.KEEP_HISTORY:
+                    self.delete_history(prompt_id)
+            if future is None or future.done():
+                return
+            if error is not None:
+                future.set_exception(PromptExecutionError(error[1], error[0] == "execution_interrupted"))
+            else:
+                future.set_result(prompt_id)
+
+    def validate(self, prompt):
+        # Returns the ids of the prompt's output nodes
+        valid = execution.validate_prompt(prompt)
+        if not valid[0]:
+            raise PromptValidationError(valid[1], valid[3])
+        return valid[2]
+
+    def submit(self, prompt, prompt_id=None, listener=None):
+        outputs = self.validate(prompt)
+
+        number = self.server.number
+        self.server.number += 1
+        if prompt_id is None:
+            prompt_id = str(uuid.uuid4())
+        future = self.server.loop.create_future()
+        self.waiting[prompt_id] = future
+        if listener is not None:
+            self.listeners[prompt_id] = listener
+        extra_data = { "client_id": self.client_id }
+        # Before it's queued, so listeners are ready for it by the time the executor picks it up
+        if listener is not None:
+            listener("submitted", { "prompt_id": prompt_id, "number": number })
+        self.server.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs))
+        return future
+
+    def cancel(self, prompt_id):
+        """
+        Stops a prompt nobody is waiting for any more. It's removed from the queue if it hasn't
+        started yet, or interrupted if it's running. Returns whether it was stopped.
+        """
+        queue = self.server.prompt_queue
+        if queue.delete_queue_item(lambda item: item[1] == prompt_id):
+            self.waiting.pop(prompt_id, None)
+            self.errors.pop(prompt_id, None)
+            self.listeners.pop(prompt_id, None)
+            self.cancelled_queued += 1
+            self.cancelled_seconds += self.average_execution or 0.0
+            return True
+
+        with queue.mutex:
+            running = any(item[1] == prompt_id for item in queue.currently_running.values())
+            # Interrupting stops whatever is running, so it has to happen while that's still this prompt
+            if running:
+                nodes.interrupt_processing()
+        if not running:
+            return False
+        self.abandoned.add(prompt_id)
+        self.interrupted += 1
+        started = self.started.get(prompt_id)
+        if self.average_execution is not None and started is not None:
+            self.cancelled_seconds += max(0.0, self.average_execution - (time.monotonic() - started))
+        return True
+
+    def stats(self):
+        return {
+            "cancelled_queued": self.cancelled_queued,
+            "interrupted": self.interrupted,
+            # Estimated from the average time prompts take, less the time interrupted ones had run for
+            "cancelled_work_seconds": round(self.cancelled_seconds, 3),
+            "average_execution_seconds": round(self.average_execution, 3) if self.average_execution is not None else None,
+        }
+
+    def queue_position(self, prompt_id):
+        """
+        How many prompts are ahead of this one in the queue, 0 if it's running, or None if it's
+        neither queued nor running.
+        """
+        queue = self.server.prompt_queue
+        with queue.mutex:
+            if any(item[1] == prompt_id for item in queue.currently_running.values()):
+                return 0
+            number = None
+            for item in queue.queue:
+                if item[1] == prompt_id:
+                    number = item[0]
+            if number is None:
+                return None
+            # The queue is a heap ordered by number, so anything with a lower number runs first
+            return len(queue.currently_running) + sum(1 for item in queue.queue if item[0] < number)
+
+    def queue_depth(self):
+        queue = self.server.prompt_queue
+        with queue.mutex:
+            return len(queue.queue) + len(queue.currently_running)
+
+    def get_history(self, prompt_id):
+        queue = self.server.prompt_queue
+        with queue.mutex:
+            return queue.history.get(prompt_id)
+
+    def delete_history(self, prompt_id):
+        queue = self.server.prompt_queue
+        with queue.mutex:
+            queue.history.pop(prompt_id, None)
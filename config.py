@@ -0,0 +1,115 @@
+import os
+
+# Settings are read from the environment once at startup
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return int(value)
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return float(value)
+
+def env_list(name):
+    # "value,value"
+    return [item.strip() for item in os.environ.get(name, "").split(",") if item.strip() != ""]
+
+def env_mapping(name, convert=str):
+    # "name=value,name=value" pairs
+    mapping = {}
+    for item in os.environ.get(name, "").split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            mapping[key.strip()] = convert(value.strip())
+    return mapping
+
+# Whether prompts run through API endpoints are kept in ComfyUI's history (and their outputs
+# repeated in the history's UI outputs). Results are always delivered to the request directly.
+KEEP_HISTORY = env_flag("APITOOLS_KEEP_HISTORY", False)
+
+# Threads used to encode and decode images for API nodes
+IMAGE_WORKERS = env_int("APITOOLS_IMAGE_WORKERS", min(8, os.cpu_count() or 1))
+
+# Threads that compile endpoints, resolve requests and merge results away from the event loop, 0 to do that on the event loop
+API_WORKERS = env_int("APITOOLS_API_WORKERS", min(4, os.cpu_count() or 1))
+# Milliseconds between measurements of how late the event loop runs what's scheduled on it, 0 to not measure
+LOOP_LAG_INTERVAL_MS = env_float("APITOOLS_LOOP_LAG_INTERVAL_MS", 500)
+
+# Most variants of one endpoint (combinations of switch outcomes) kept compiled at once
+ENDPOINT_VARIANTS = env_int("APITOOLS_ENDPOINT_VARIANTS", 32)
+
+# Opt-in cache of results for requests that are fully deterministic (e.g. a pinned seed)
+RESULT_CACHE = env_flag("APITOOLS_RESULT_CACHE", False)
+RESULT_CACHE_ENTRIES = env_int("APITOOLS_RESULT_CACHE_ENTRIES", 256)
+RESULT_CACHE_BYTES = env_int("APITOOLS_RESULT_CACHE_BYTES", 512 * 1024 * 1024)
+# Seconds before a cached result expires, 0 to keep results until they're evicted
+RESULT_CACHE_TTL = env_float("APITOOLS_RESULT_CACHE_TTL", 0)
+# Also keep results on disk, in the api_cache folder within the ComfyUI folder
+RESULT_CACHE_DISK = env_flag("APITOOLS_RESULT_CACHE_DISK", False)
+RESULT_CACHE_DISK_BYTES = env_int("APITOOLS_RESULT_CACHE_DISK_BYTES", 4 * 1024 * 1024 * 1024)
+
+# Milliseconds to hold requests for the same endpoint (and switch outcomes) so they can be submitted
+# together as one prompt, 0 to submit every request as soon as it arrives
+BATCH_WINDOW_MS = env_float("APITOOLS_BATCH_WINDOW_MS", 0)
+# Most requests submitted in one prompt
+BATCH_MAX_SIZE = env_int("APITOOLS_BATCH_MAX_SIZE", 8)
+# Node classes, beyond the loaders and encoders in batching.SHARED_NODES, that give the same result for
+# the same inputs and so run once for every request in a batch that has them, e.g. "MyLoader,MyEncoder"
+BATCH_SHARED_NODES = env_list("APITOOLS_BATCH_SHARED_NODES")
+
+# Requests to API endpoints allowed to run at once, overall and per endpoint, 0 for no limit.
+# Requests beyond that wait their turn, and once MAX_WAITING are waiting further ones get a 429.
+MAX_CONCURRENT = env_int("APITOOLS_MAX_CONCURRENT", 0)
+MAX_CONCURRENT_PER_ENDPOINT = env_int("APITOOLS_MAX_CONCURRENT_PER_ENDPOINT", 0)
+MAX_WAITING = env_int("APITOOLS_MAX_WAITING", 0)
+# Limits for specific endpoints, e.g. "txt2img=2,upscale=1"
+ENDPOINT_CONCURRENCY = env_mapping("APITOOLS_ENDPOINT_CONCURRENCY", int)
+# Default priority of specific endpoints, e.g. "txt2img=low", for requests without an X-Priority header
+ENDPOINT_PRIORITY = env_mapping("APITOOLS_ENDPOINT_PRIORITY")
+# Seconds a request may take, including time spent waiting, 0 for no limit. X-Timeout overrides it.
+REQUEST_TIMEOUT = env_float("APITOOLS_REQUEST_TIMEOUT", 0)
+
+# Milliseconds between checks for whether the client of a running request has disconnected, in
+# which case its prompt is cancelled. 0 to only cancel when aiohttp cancels the handler.
+DISCONNECT_POLL_MS = env_float("APITOOLS_DISCONNECT_POLL_MS", 250)
+
+# Most often a streaming request that asked for previews is sent one, in milliseconds
+PREVIEW_INTERVAL_MS = env_float("APITOOLS_PREVIEW_INTERVAL_MS", 500)
+# Seconds without any events before a streaming request is sent a keep-alive
+STREAM_KEEPALIVE = env_float("APITOOLS_STREAM_KEEPALIVE", 15)
+
+# Finished jobs are kept for JOB_RESULTS_TTL seconds (0 until they're evicted), bounded by count and size
+JOB_RESULTS_ENTRIES = env_int("APITOOLS_JOB_RESULTS_ENTRIES", 1024)
+JOB_RESULTS_BYTES = env_int("APITOOLS_JOB_RESULTS_BYTES", 1024 * 1024 * 1024)
+JOB_RESULTS_TTL = env_float("APITOOLS_JOB_RESULTS_TTL", 3600)
+# Also keep finished jobs on disk, in the api_jobs folder within the ComfyUI folder
+JOB_RESULTS_DISK = env_flag("APITOOLS_JOB_RESULTS_DISK", False)
+JOB_RESULTS_DISK_BYTES = env_int("APITOOLS_JOB_RESULTS_DISK_BYTES", 4 * 1024 * 1024 * 1024)
+
+# Compile every endpoint when the server starts, and also run the warm-up request of each endpoint
+# that has a <name>.warmup.json next to it
+PREWARM = env_flag("APITOOLS_PREWARM", False)
+PREWARM_WARMUP = env_flag("APITOOLS_PREWARM_WARMUP", False)
+
+# Profile every request to an API endpoint (otherwise only those with an X-Profile header), keeping
+# the most recent PROFILE_ENTRIES profiles. PROFILE_SAMPLE_RATE of them also get a cProfile.
+PROFILE = env_flag("APITOOLS_PROFILE", False)
+PROFILE_ENTRIES = env_int("APITOOLS_PROFILE_ENTRIES", 256)
+PROFILE_SAMPLE_RATE = env_float("APITOOLS_PROFILE_SAMPLE_RATE", 0)
+
+# Append a sample of the requests made to API endpoints to this JSONL file (relative to the ComfyUI
+# folder), for benchmarks/replay.py. Images are replaced by a stub with their size unless
+# RECORD_IMAGES is set.
+RECORD_REQUESTS = os.environ.get("APITOOLS_RECORD_REQUESTS", "")
+RECORD_SAMPLE_RATE = env_float("APITOOLS_RECORD_SAMPLE_RATE", 1)
+RECORD_IMAGES = env_flag("APITOOLS_RECORD_IMAGES", False)
@@ -0,0 +1,206 @@
+import io
+import asyncio
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+
+from . import config
+from .profiling import profiled
+from .uploads import is_upload, upload_store
+
+IMAGE_FORMATS = ["png", "jpeg", "webp", "webp_lossless"]
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "webp_lossless": "image/webp",
+}
+
+# PIL releases the GIL while encoding and decoding, so a thread pool gives real parallelism
+image_pool = ThreadPoolExecutor(max_workers=config.IMAGE_WORKERS, thread_name_prefix="apitools-images")
+
+def sniff_content_type(data):
+    if data[:4] == b"\x89PNG":
+        return "image/png"
+    if data[:2] == b"\xff\xd8":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def map_images(function, items):
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    return list(image_pool.map(function, items))
+
+def to_uint8(images):
+    # One conversion for the whole batch rather than one per image
+    array = (images * 255).clamp(0, 255).to(torch.uint8).cpu().numpy()
+    if array.shape[-1] == 1:
+        array = array[..., 0]
+    return array
+
+def encode_array(array, format="png", quality=95, compress_level=4):
+    im = Image.fromarray(array)
+    f = io.BytesIO()
+    if format == "png":
+        im.save(f, format="PNG", compress_level=compress_level)
+    elif format == "jpeg":
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        im.save(f, format="JPEG", quality=quality)
+    elif format == "webp":
+        im.save(f, format="WEBP", quality=quality)
+    elif format == "webp_lossless":
+        im.save(f, format="WEBP", lossless=True, quality=quality)
+    else:
+        raise ValueError("Unknown image format '{}', expected one of: {}".format(format, ", ".join(IMAGE_FORMATS)))
+    return f.getvalue()
+
+def encode_images(images, format="png", quality=95, compress_level=4):
+    """
+    Encodes a B x H x W x C float tensor into a list of encoded image files.
+    """
+    array = to_uint8(images)
+    return map_images(lambda image: encode_array(image, format, quality, compress_level), list(array))
+
+@profiled("serialize_image")
+def serialize_image(images, format="png", quality=95, compress_level=4):
+    return [base64.b64encode(data).decode("utf-8") for data in encode_images(images, format, quality, compress_level)]
+
+class EncodedImage:
+    """
+    An image produced by a Serialize (API) node. It is only encoded once a response actually needs
+    it, so binary responses never go through base64 and JSON ones only do so once. Images are
+    shared between requests and may be encoded from several threads at once.
+    """
+    __slots__ = ("array", "format", "quality", "compress_level", "data", "lock")
+
+    def __init__(self, array, format, quality, compress_level):
+        self.array = array
+        self.format = format
+        self.quality = quality
+        self.compress_level = compress_level
+        self.data = None
+        self.lock = threading.Lock()
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+    def encode(self):
+        data = self.data
+        if data is None:
+            with self.lock:
+                # Another thread may have encoded it while we were waiting on the lock
+                if self.data is None:
+                    self.data = encode_array(self.array, self.format, self.quality, self.compress_level)
+                    self.array = None
+                data = self.data
+        return data
+
+    def to_base64(self):
+        return base64.b64encode(self.encode()).decode("utf-8")
+
+    # Results are pickled for the disk tiers, which can't keep the lock. array is read before data, so
+    # an encode finishing at the same time leaves at least one of them set.
+    def __getstate__(self):
+        return (self.array, self.format, self.quality, self.compress_level, self.data)
+
+    def __setstate__(self, state):
+        self.array, self.format, self.quality, self.compress_level, self.data = state
+        self.lock = threading.Lock()
+
+    # Never modified once created, so copies can share it
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+@profiled("lazy_images")
+def lazy_images(images, format="png", quality=95, compress_level=4):
+    if format not in CONTENT_TYPES:
+        raise ValueError("Unknown image format '{}', expected one of: {}".format(format, ", ".join(IMAGE_FORMATS)))
+    return [EncodedImage(array, format, quality, compress_level) for array in to_uint8(images)]
+
+def collect_images(obj, found=None):
+    if found is None:
+        found = []
+    if isinstance(obj, EncodedImage):
+        found.append(obj)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            collect_images(value, found)
+    elif isinstance(obj, list):
+        for value in obj:
+            collect_images(value, found)
+    return found
+
+def replace_images(obj, function):
+    """
+    Returns a copy of a JSON result with every EncodedImage replaced by function(image).
+    """
+    if isinstance(obj, EncodedImage):
+        return function(obj)
+    elif isinstance(obj, dict):
+        return {key: replace_images(value, function) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [replace_images(value, function) for value in obj]
+    return obj
+
+async def encode_all(images):
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[loop.run_in_executor(image_pool, image.encode) for image in images])
+
+def materialize_images(obj):
+    map_images(EncodedImage.encode, collect_images(obj))
+    return replace_images(obj, EncodedImage.to_base64)
+
+def encode_preview(preview):
+    # Previews come from ComfyUI as [format, PIL image, max size]
+    format, image, max_size = preview
+    if max_size is not None:
+        image = image.copy()
+        image.thumbnail((max_size, max_size))
+    f = io.BytesIO()
+    image.save(f, format=format, quality=80)
+    return {
+        "image": base64.b64encode(f.getvalue()).decode("utf-8"),
+        "content_type": "image/" + format.lower(),
+    }
+
+def decode_image(data):
+    if is_upload(data):
+        data = upload_store.get(data)
+    elif isinstance(data, str):
+        data = base64.b64decode(data)
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    return np.array(image)
+
+@profiled("deserialize_image")
+def deserialize_image(image_input):
+    """
+    Decodes one or more base64 encoded or uploaded images into a single B x H x W x 3 float tensor.
+    """
+    if not isinstance(image_input, list):
+        image_input = [image_input]
+    if len(image_input) == 0:
+        return None
+
+    arrays = map_images(decode_image, image_input)
+    H, W, C = arrays[0].shape
+    for i, array in enumerate(arrays):
+        if array.shape != (H, W, C):
+            raise ValueError("Images in a batch must all be the same size, but image {} is {}x{} and image 0 is {}x{}".format(i, array.shape[1], array.shape[0], W, H))
+
+    # Written in place so there's only one float allocation, however many images there are
+    result = torch.empty((len(arrays), H, W, C), dtype=torch.float32)
+    for i, array in enumerate(arrays):
+        result[i].copy_(torch.from_numpy(array))
+    result.div_(255.0)
+    return result
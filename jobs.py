@@ -0,0 +1,90 @@
+import time
+import uuid
+
+from .cache import estimate_size
+
+class Job:
+    """
+    A request that runs in the background. Its status follows the events for its prompt:
+    waiting (for admission), queued, running, and then completed or failed.
+    """
+    def __init__(self, endpoint):
+        self.id = str(uuid.uuid4())
+        self.endpoint = endpoint
+        self.status = "waiting"
+        self.prompt_id = None
+        self.created = time.time()
+        self.submitted = None
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.error_status = None
+
+    def listener(self, event, data):
+        if event == "submitted":
+            self.status = "queued"
+            self.prompt_id = data["prompt_id"]
+            self.submitted = time.time()
+        elif event == "execution_start":
+            self.status = "running"
+            self.started = time.time()
+
+    def complete(self, result):
+        self.status = "completed"
+        self.result = result
+        self.finished = time.time()
+
+    def fail(self, status, error):
+        self.status = "failed"
+        self.error_status = status
+        self.error = error
+        self.finished = time.time()
+
+    def describe(self, queue_position=None):
+        description = {
+            "id": self.id,
+            "status": self.status,
+            "prompt_id": self.prompt_id,
+            "created": self.created,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if self.status == "queued":
+            description["queue_position"] = queue_position
+        if self.started is not None:
+            description["wait_seconds"] = self.started - self.created
+            if self.finished is not None:
+                description["run_seconds"] = self.finished - self.started
+        if self.error is not None:
+            description["error"] = self.error
+        return description
+
+class JobStore:
+    """
+    Jobs that are still running, and finished ones in a bounded LRUStore until they expire or are
+    evicted.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.active = {}
+        self.submitted = 0
+
+    def add(self, job):
+        self.active[job.id] = job
+        self.submitted += 1
+
+    def get(self, job_id):
+        job = self.active.get(job_id)
+        if job is None:
+            job = self.store.get(job_id)
+        return job
+
+    def finish(self, job):
+        # Results are already encoded, so their size is known
+        self.store.put(job.id, job, estimate_size(job.result) + estimate_size(job.error))
+        del self.active[job.id]
+
+    def stats(self):
+        return dict(self.store.stats(), active=len(self.active), submitted=self.submitted)
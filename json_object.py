@@ -0,0 +1,52 @@
+class JSONObject:
+    """
+    The value carried by JSON_OBJECT links: a persistent sequence of (path, value) entries.
+    Appending to or merging objects is O(1) and shares everything that came before, so a long
+    chain of Serialize (API) nodes doesn't copy the chain at every link. The entries are only
+    walked once, when API Output builds the final object.
+    """
+    __slots__ = ("children", "entries")
+
+    def __init__(self, children=(), entries=()):
+        self.children = children
+        self.entries = entries
+
+    def append(self, path, value):
+        return JSONObject((self,), ((path, value),))
+
+    def items(self):
+        # Children come before the node's own entries. Iterative so deep chains can't overflow the stack.
+        stack = [(self, False)]
+        while stack:
+            obj, expanded = stack.pop()
+            if expanded:
+                yield from obj.entries
+            else:
+                stack.append((obj, True))
+                for child in reversed(obj.children):
+                    stack.append((as_json_object(child), False))
+
+def as_json_object(value):
+    # Plain lists of (path, value) pairs are what JSON_OBJECT used to be
+    if isinstance(value, JSONObject):
+        return value
+    return JSONObject((), tuple(value))
+
+def append_entry(json_object, path, value):
+    if json_object is None:
+        return JSONObject((), ((path, value),))
+    return as_json_object(json_object).append(path, value)
+
+def merge_objects(*objects):
+    return JSONObject(tuple(obj for obj in objects if obj is not None))
+
+def detach(value):
+    """
+    Copies the containers in a value so the final object can be modified without affecting the
+    node outputs ComfyUI caches. Strings, numbers and images are immutable and are shared.
+    """
+    if isinstance(value, dict):
+        return {key: detach(item) for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [detach(item) for item in value]
+    return value
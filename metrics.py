@@ -0,0 +1,198 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PHASE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+class PhaseTimer:
+    """
+    Accumulates the time a request spends in each phase, in the order the phases first happen.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.submitted = None
+        self.started = None
+        # The endpoint the request was for, once it's known to exist
+        self.endpoint = None
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def on_event(self, event, data):
+        # Time in ComfyUI's queue and executing come from the prompt's events
+        now = time.perf_counter()
+        if event == "submitted":
+            self.submitted = now
+        elif event == "execution_start" and self.submitted is not None:
+            self.started = now
+            self.add("queue", now - self.submitted)
+        elif event == "executing" and data.get("node") is None and self.started is not None:
+            self.add("execution", now - self.started)
+
+    def wrap(self, listener):
+        def timed_listener(event, data):
+            self.on_event(event, data)
+            if listener is not None:
+                listener(event, data)
+        return timed_listener
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        timings = ["{};dur={:.1f}".format(name, seconds * 1000) for name, seconds in self.phases.items()]
+        timings.append("total;dur={:.1f}".format(self.total() * 1000))
+        return ", ".join(timings)
+
+# The timer of the request being handled, so phases deep in the call stack can be timed without
+# passing it everywhere. Tasks started by a request inherit it.
+current_timer = contextvars.ContextVar("apitools_timer", default=None)
+
+def phase(name):
+    timer = current_timer.get()
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.phase(name)
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in zip(names, values)) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        for label_values, value in sorted(self.values.items()):
+            lines.append("{}{} {}".format(self.name, format_labels(self.labels, label_values), format_value(value)))
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> (count per bucket, sum, count)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[label_values] = entry
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ("le",), label_values + (format_value(float(bound)),))
+                lines.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+            labels = format_labels(self.labels, label_values)
+            lines.append("{}_sum{} {}".format(self.name, labels, format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, labels, count))
+        return lines
+
+class Gauge:
+    """
+    A value read when the metrics are rendered. function returns either a number or a dict from
+    label values to numbers. kind is "counter" for values that are kept elsewhere but only go up.
+    """
+    def __init__(self, name, help, function, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = labels
+        self.kind = kind
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            if value is not None:
+                lines.append("{}{} {}".format(self.name, format_labels(self.labels, label_values), format_value(value)))
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class LoopLagMonitor:
+    """
+    Measures how much later than asked the event loop wakes up a task that sleeps for interval
+    seconds, which is how long anything that blocks the loop keeps every other client waiting.
+    """
+    def __init__(self, histogram, interval):
+        self.histogram = histogram
+        self.interval = interval
+        self.last = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.last = lag
+            self.histogram.observe((), lag)
+
+metrics = MetricsRegistry()
+request_duration = metrics.add(Histogram("apitools_request_duration_seconds", "Time to handle API requests.", ("endpoint", "route", "status")))
+phase_duration = metrics.add(Histogram("apitools_request_phase_seconds", "Time API requests spend in each phase.", ("endpoint", "phase"), PHASE_BUCKETS))
+requests_total = metrics.add(Counter("apitools_requests_total", "API requests handled.", ("endpoint", "route", "status")))
+request_bytes = metrics.add(Counter("apitools_request_bytes_total", "Bytes received in API request bodies.", ("endpoint",)))
+response_bytes = metrics.add(Counter("apitools_response_bytes_total", "Bytes sent in API response bodies.", ("endpoint",)))
+loop_lag = metrics.add(Histogram("apitools_event_loop_lag_seconds", "How late the event loop ran scheduled callbacks.", (), LAG_BUCKETS))
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import nodes
+
+def node_info(node_class):
+    # The same as what /object_info reports for the class, which is what workflows are built against
+    obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
+    input_types = obj_class.INPUT_TYPES()
+    info = {
+        "input": input_types,
+        "input_order": {key: list(value.keys()) for key, value in input_types.items()},
+        "output": obj_class.RETURN_TYPES,
+        "output_is_list": getattr(obj_class, "OUTPUT_IS_LIST", [False] * len(obj_class.RETURN_TYPES)),
+        "output_name": getattr(obj_class, "RETURN_NAMES", obj_class.RETURN_TYPES),
+        "name": node_class,
+        "display_name": nodes.NODE_DISPLAY_NAME_MAPPINGS.get(node_class, node_class),
+        "category": getattr(obj_class, "CATEGORY", "sd"),
+        "output_node": getattr(obj_class, "OUTPUT_NODE", False) == True,
+    }
+    # Round tripped through JSON so tuples become lists, exactly as they would over HTTP
+    return json.loads(json.dumps(info, default=str))
+
+def mappings_signature():
+    return hash(tuple((name, id(obj_class)) for name, obj_class in nodes.NODE_CLASS_MAPPINGS.items()))
+
+class NodeDefinitions:
+    """
+    Node definitions read straight from NODE_CLASS_MAPPINGS. They're rebuilt whenever a node class
+    is added, removed or replaced (or invalidate() is called), and each rebuild gets a new version
+    that anything compiled from the definitions can be keyed on. Concurrent requests for the
+    definitions share a single build.
+    """
+    def __init__(self):
+        self.defs = None
+        self.version = 0
+        self.signature = None
+        self.lock = None
+        self.builds = 0
+
+    def current(self):
+        return self.defs is not None and self.signature == mappings_signature()
+
+    def build(self):
+        signature = mappings_signature()
+        defs = {}
+        for node_class in list(nodes.NODE_CLASS_MAPPINGS):
+            try:
+                defs[node_class] = node_info(node_class)
+            except Exception as e:
+                print("Error getting the definition of", node_class, e)
+        return signature, defs
+
+    async def get(self):
+        """
+        Returns the version and the definitions.
+        """
+        if self.current():
+            return self.version, self.defs
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # Someone else may have rebuilt them while we were waiting
+            if not self.current():
+                # INPUT_TYPES often lists files on disk, so this stays off the event loop
+                self.signature, self.defs = await asyncio.get_running_loop().run_in_executor(None, self.build)
+                self.version += 1
+                self.builds += 1
+            return self.version, self.defs
+
+    def invalidate(self):
+        self.signature = None
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "builds": self.builds,
+            "node_types": len(self.defs) if self.defs is not None else 0,
+        }
+
+node_definitions = NodeDefinitions()
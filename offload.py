@@ -0,0 +1,27 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Reading and compiling endpoints, resolving requests and merging results run here, so they don't
+# hold up the event loop every other client of the server shares. They're pure Python, so the loop
+# gets its turn every few milliseconds while they run.
+api_pool = ThreadPoolExecutor(max_workers=config.API_WORKERS, thread_name_prefix="apitools-api") if config.API_WORKERS > 0 else None
+
+async def run_off_loop(function, *args):
+    if api_pool is None:
+        return function(*args)
+    return await asyncio.get_running_loop().run_in_executor(api_pool, function, *args)
+
+def json_loads(data):
+    # Parsing holds the GIL from start to end, so there's nothing to gain from doing it on another
+    # thread. orjson raises a subclass of json.JSONDecodeError, so callers can handle either the same way.
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,122 @@
+import functools
+import re
+
+# Paths are compiled into tuples of steps. A step is a str for an object key, an int for a list
+# index and APPEND for the output-only `[]` syntax.
+class _Append:
+    def __repr__(self):
+        return "APPEND"
+
+APPEND = _Append()
+
+class PathError(ValueError):
+    pass
+
+@functools.lru_cache(maxsize=4096)
+def compile_path(path):
+    if not isinstance(path, str):
+        raise PathError("Path must be a string, not {}".format(type(path).__name__))
+    steps = []
+    parts = re.split(r'([\.\[])', path)
+    # parts alternates between tokens and the separator that preceded the next token
+    for i in range(0, len(parts), 2):
+        token = parts[i]
+        if i > 0 and parts[i - 1] == "[":
+            if token == "]":
+                steps.append(APPEND)
+                continue
+            try:
+                if not token.endswith("]"):
+                    raise ValueError()
+                steps.append(int(token[:-1]))
+            except ValueError:
+                raise PathError("Invalid index '[{}' in path '{}'".format(token, path))
+        elif token == "":
+            raise PathError("Empty key in path '{}'".format(path))
+        elif "]" in token:
+            raise PathError("Unexpected ']' in path '{}'".format(path))
+        else:
+            steps.append(token)
+    return tuple(steps)
+
+def compile_read_path(path):
+    # For paths that are only read from, where there's nothing to append to
+    steps = compile_path(path)
+    if any(step is APPEND for step in steps):
+        raise PathError("Paths using '[]' can only be used for output, not '{}'".format(path))
+    return steps
+
+def get_path(obj, steps):
+    """
+    Returns the value at the compiled path or None if the object doesn't contain it.
+    """
+    current = obj
+    for step in steps:
+        if type(step) is str:
+            if not isinstance(current, dict):
+                return None
+            current = current.get(step)
+        elif step is APPEND:
+            raise PathError("Paths using '[]' can only be used for output")
+        else:
+            if not isinstance(current, list) or step >= len(current) or step < -len(current):
+                return None
+            current = current[step]
+        if current is None:
+            return None
+    return current
+
+def _describe(steps, count):
+    result = ""
+    for step in steps[:count]:
+        if step is APPEND:
+            result += "[]"
+        elif type(step) is int:
+            result += "[{}]".format(step)
+        elif result == "":
+            result = step
+        else:
+            result += "." + step
+    return result or "<root>"
+
+def set_path(obj, steps, value):
+    current = obj
+    last = len(steps) - 1
+    for i in range(last):
+        step = steps[i]
+        next_is_list = type(steps[i + 1]) is not str
+        if type(step) is str:
+            if not isinstance(current, dict):
+                raise PathError("Expected an object at '{}'".format(_describe(steps, i)))
+            if step not in current:
+                current[step] = [] if next_is_list else {}
+            current = current[step]
+        else:
+            if not isinstance(current, list):
+                raise PathError("Expected a list at '{}'".format(_describe(steps, i)))
+            if step is APPEND:
+                current.append([] if next_is_list else {})
+                current = current[-1]
+            else:
+                key = step
+                if key == -1 and len(current) == 0:
+                    key = 0
+                if key >= len(current):
+                    current += [None] * (key - len(current) + 1)
+                if current[key] is None:
+                    current[key] = [] if next_is_list else {}
+                current = current[key]
+
+    step = steps[last]
+    if type(step) is str:
+        if not isinstance(current, dict):
+            raise PathError("Expected an object at '{}'".format(_describe(steps, last)))
+        current[step] = value
+    elif not isinstance(current, list):
+        raise PathError("Expected a list at '{}'".format(_describe(steps, last)))
+    elif step is APPEND:
+        current.append(value)
+    else:
+        if step >= len(current):
+            current += [None] * (step - len(current) + 1)
+        current[step] = value
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import os
+import time
+
+# A request body to run once when prewarming an endpoint, so e.g. its checkpoint is loaded
+WARMUP_SUFFIX = ".warmup.json"
+
+def list_endpoints(endpoints_path):
+    if not os.path.isdir(endpoints_path):
+        return []
+    files = [f for f in os.listdir(endpoints_path) if os.path.isfile(os.path.join(endpoints_path, f)) and f.endswith(".json") and not f.endswith(WARMUP_SUFFIX)]
+    return sorted(os.path.splitext(f)[0] for f in files)
+
+def read_warmup(endpoints_path, endpoint_name):
+    path = os.path.join(endpoints_path, endpoint_name + WARMUP_SUFFIX)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+class Prewarmer:
+    """
+    Compiles every endpoint in the given folders ahead of their first request and, if asked to,
+    runs each one's warm-up request. compile_endpoint(name, path) and warm_up(endpoint, body) are
+    coroutines supplied by the server.
+    """
+    def __init__(self, folders, compile_endpoint, warm_up):
+        self.folders = folders
+        self.compile_endpoint = compile_endpoint
+        self.warm_up = warm_up
+        self.status = "idle"
+        self.started = None
+        self.finished = None
+        self.endpoints = {}
+        self.task = None
+
+    @property
+    def ready(self):
+        # Nothing to wait for if prewarming was never asked for
+        return self.status in ("idle", "ready")
+
+    def start(self, run_warmups):
+        if self.status != "running":
+            self.status = "running"
+            self.task = asyncio.ensure_future(self.run(run_warmups))
+        return self.task
+
+    async def run(self, run_warmups):
+        self.started = time.time()
+        self.finished = None
+        self.endpoints = {}
+        for prefix, endpoints_path in self.folders:
+            for endpoint_name in list_endpoints(endpoints_path):
+                entry = { "compiled": False, "warmed_up": False }
+                self.endpoints[prefix + endpoint_name] = entry
+                start = time.perf_counter()
+                try:
+                    endpoint = await self.compile_endpoint(endpoint_name, endpoints_path)
+                    entry["compiled"] = True
+                    body = read_warmup(endpoints_path, endpoint_name) if run_warmups else None
+                    if body is not None:
+                        await self.warm_up(endpoint, body)
+                        entry["warmed_up"] = True
+                except Exception as e:
+                    print("Error prewarming endpoint", prefix + endpoint_name, e)
+                    entry["error"] = str(e)
+                entry["seconds"] = time.perf_counter() - start
+                # Compiling only happens on the event loop with APITOOLS_API_WORKERS=0, in which case
+                # this lets requests in between endpoints
+                await asyncio.sleep(0)
+        self.finished = time.time()
+        # An endpoint that didn't compile or warm up would fail its requests, so the server isn't ready
+        self.status = "failed" if len(self.failures()) > 0 else "ready"
+
+    def failures(self):
+        return sorted(name for name, entry in self.endpoints.items() if "error" in entry)
+
+    def describe(self):
+        return {
+            "status": self.status,
+            "ready": self.ready,
+            "started": self.started,
+            "finished": self.finished,
+            "failures": self.failures(),
+            "endpoints": self.endpoints,
+        }
@@ -0,0 +1,219 @@
+import cProfile
+import collections
+import contextlib
+import functools
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from folder_paths import base_path
+
+from . import config
+
+# Most expensive functions reported from a cProfile
+TOP_FUNCTIONS = 25
+
+# The profile of the prompt the executor is running, set on the executor's thread
+local = threading.local()
+
+def current_profile():
+    return getattr(local, "profile", None)
+
+class Profile:
+    """
+    Wall time, CPU time and memory allocated by the API nodes' hot paths while one prompt runs, by
+    function, and optionally a cProfile of the whole prompt. Everything is recorded on the
+    executor's thread.
+    """
+    def __init__(self, prompt_id, cprofile=False):
+        self.prompt_id = prompt_id
+        self.status = "pending"
+        self.cprofile = cprofile
+        self.created = time.time()
+        self.started = None
+        self.start_time = None
+        self.execution_seconds = None
+        # Time in the outermost recorded calls, i.e. the API nodes themselves
+        self.api_seconds = 0.0
+        self.functions = {}
+        # [memory in use at the start of a recorded call, highest it has been since]
+        self.frames = []
+        self.started_tracing = False
+        self.profiler = None
+        self.top_functions = None
+        self.dump_path = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.status = "running"
+        self.started = time.time()
+        self.start_time = time.perf_counter()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        if self.cprofile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self.profiler = profiler
+            except ValueError as e:
+                # Only one profiler can be active at a time
+                print("Error starting cProfile for prompt", self.prompt_id, e)
+
+    def stop(self, folder):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.execution_seconds = time.perf_counter() - self.start_time
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        if self.profiler is not None:
+            stats = pstats.Stats(self.profiler)
+            self.top_functions = [{
+                "function": "{}:{}({})".format(*function),
+                "calls": calls,
+                "own_seconds": round(own, 6),
+                "cumulative_seconds": round(cumulative, 6),
+            } for function, (_, calls, own, cumulative, _) in sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]]
+            try:
+                os.makedirs(folder, exist_ok=True)
+                path = os.path.join(folder, self.prompt_id + ".prof")
+                stats.dump_stats(path)
+                self.dump_path = path
+            except OSError as e:
+                print("Error writing the profile of prompt", self.prompt_id, e)
+            self.profiler = None
+        self.status = "finished"
+
+    @contextlib.contextmanager
+    def record(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        # The peak is shared with the calls this one is inside of, so they keep what it reached first
+        for frame in self.frames:
+            frame[1] = max(frame[1], peak)
+        outermost = len(self.frames) == 0
+        frame = [current, current]
+        self.frames.append(frame)
+        tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        # Process time, so work handed to the image threads counts too
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self.frames.pop()
+            frame[1] = max(frame[1], tracemalloc.get_traced_memory()[1])
+            for outer in self.frames:
+                outer[1] = max(outer[1], frame[1])
+            with self.lock:
+                if outermost:
+                    self.api_seconds += wall
+                entry = self.functions.setdefault(name, { "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "allocated_bytes": 0 })
+                entry["calls"] += 1
+                entry["wall_seconds"] += wall
+                entry["cpu_seconds"] += cpu
+                entry["allocated_bytes"] += frame[1] - frame[0]
+
+    def discard(self):
+        if self.dump_path is not None:
+            try:
+                os.remove(self.dump_path)
+            except OSError:
+                pass
+
+    def describe(self):
+        with self.lock:
+            functions = {name: dict(entry, wall_seconds=round(entry["wall_seconds"], 6), cpu_seconds=round(entry["cpu_seconds"], 6)) for name, entry in self.functions.items()}
+            api_seconds = self.api_seconds
+        description = {
+            "prompt_id": self.prompt_id,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "execution_seconds": self.execution_seconds,
+            "api_seconds": round(api_seconds, 6),
+            "functions": functions,
+        }
+        if self.execution_seconds is not None:
+            # Everything else the prompt ran, the sampler included
+            description["other_seconds"] = round(max(0.0, self.execution_seconds - api_seconds), 6)
+        if self.top_functions is not None:
+            description["cprofile"] = {
+                "file": os.path.basename(self.dump_path) if self.dump_path is not None else None,
+                "top_functions": self.top_functions,
+            }
+        return description
+
+class Profiler:
+    """
+    Profiles of the prompts that were asked to be profiled, keeping the most recent max_entries.
+    sample_rate is the share of them that also get a cProfile.
+    """
+    def __init__(self, folder, max_entries, sample_rate):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.sample_rate = sample_rate
+        self.profiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def expect(self, prompt_id, cprofile=False):
+        """
+        Profiles the prompt when it runs. Has to be called before it can start.
+        """
+        with self.lock:
+            profile = self.profiles.get(prompt_id)
+            if profile is None:
+                profile = Profile(prompt_id, cprofile or random.random() < self.sample_rate)
+                self.profiles[prompt_id] = profile
+                while len(self.profiles) > self.max_entries:
+                    self.profiles.popitem(last=False)[1].discard()
+            elif cprofile and profile.status == "pending":
+                # Another request sharing the prompt asked for more
+                profile.cprofile = True
+            return profile
+
+    def on_event(self, event, data):
+        # Called on the executor's thread, so profiling starts and stops right around the prompt's nodes
+        if event == "execution_start":
+            with self.lock:
+                profile = self.profiles.get(data.get("prompt_id"))
+            if profile is not None and profile.status == "pending":
+                profile.start()
+                local.profile = profile
+        elif event == "executing" and data.get("node") is None:
+            profile = current_profile()
+            if profile is not None and profile.prompt_id == data.get("prompt_id"):
+                local.profile = None
+                profile.stop(self.folder)
+
+    def get(self, prompt_id):
+        with self.lock:
+            return self.profiles.get(prompt_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.profiles),
+                "cprofiles": sum(1 for profile in self.profiles.values() if profile.dump_path is not None),
+            }
+
+def profiled(name):
+    """
+    Records calls to the function in the profile of the prompt being run, if it's being profiled.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profile = current_profile()
+            if profile is None:
+                return function(*args, **kwargs)
+            with profile.record(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+profiler = Profiler(os.path.join(base_path, "api_profiles"), config.PROFILE_ENTRIES, config.PROFILE_SAMPLE_RATE)
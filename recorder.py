@@ -0,0 +1,91 @@
+import base64
+import io
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from .uploads import is_upload, upload_store
+
+# How base64 encoded PNG, JPEG and WEBP files start
+IMAGE_PREFIXES = ("iVBORw0KGgo", "/9j/", "UklGR")
+# Stands in for an image that wasn't recorded, e.g. "$image:512x512"
+IMAGE_STUB_PREFIX = "$image:"
+
+def is_base64_image(value):
+    return isinstance(value, str) and len(value) > 64 and value.startswith(IMAGE_PREFIXES)
+
+def capture_uploads(obj):
+    # Uploads are released when the request finishes, so their bytes have to be taken before then
+    if is_upload(obj):
+        return upload_store.get(obj)
+    elif isinstance(obj, dict):
+        return {key: capture_uploads(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [capture_uploads(value) for value in obj]
+    return obj
+
+def image_stub(data):
+    try:
+        width, height = Image.open(io.BytesIO(data)).size
+    except Exception:
+        width, height = 64, 64
+    return "{}{}x{}".format(IMAGE_STUB_PREFIX, width, height)
+
+def recordable(obj, keep_images):
+    """
+    The body as it's recorded: uploaded files become base64 strings, like images sent in JSON, and
+    unless keep_images is set every image is replaced by a stub with its size.
+    """
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode("utf-8") if keep_images else image_stub(obj)
+    elif is_base64_image(obj) and not keep_images:
+        return image_stub(base64.b64decode(obj))
+    elif isinstance(obj, dict):
+        return {key: recordable(value, keep_images) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [recordable(value, keep_images) for value in obj]
+    return obj
+
+class RequestRecorder:
+    """
+    Appends a sample of the requests made to API endpoints to a JSONL file, which
+    benchmarks/replay.py can replay. Entries are written in order on a thread of their own.
+    """
+    def __init__(self, path, sample_rate, keep_images):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.keep_images = keep_images
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="apitools-recorder")
+        self.recorded = 0
+
+    def sampled(self):
+        return random.random() < self.sample_rate
+
+    def record(self, method, path, query, body, status, seconds):
+        entry = {
+            "time": time.time(),
+            "method": method,
+            "path": path,
+            "query": query,
+            "body": capture_uploads(body),
+            "status": status,
+            "seconds": round(seconds, 6),
+        }
+        self.recorded += 1
+        self.writer.submit(self.write, entry)
+
+    def write(self, entry):
+        try:
+            entry["body"] = recordable(entry["body"], self.keep_images)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        except Exception as e:
+            print("Error recording a request to", self.path, e)
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "recorded": self.recorded,
+        }
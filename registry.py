@@ -0,0 +1,54 @@
+import os
+import threading
+
+from .offload import json_loads
+
+def file_version(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+class EndpointRegistry:
+    """
+    Keeps one compiled endpoint per workflow file. An entry is recompiled whenever the file's
+    mtime or size, or the version of the node definitions it was compiled with, no longer matches.
+    Compiled endpoints are shared between requests and must never be modified.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, endpoint_path, compile_function, defs_version=None):
+        version = (file_version(endpoint_path), defs_version)
+        entry = self.entries.get(endpoint_path)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+
+        with self.lock:
+            # Another request may have compiled it while we were waiting on the lock
+            entry = self.entries.get(endpoint_path)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            with open(endpoint_path, "rb") as f:
+                graph = json_loads(f.read())
+            compiled = compile_function(graph, version)
+            self.entries[endpoint_path] = (version, compiled)
+            return compiled
+
+    def invalidate(self, endpoint_path=None):
+        with self.lock:
+            if endpoint_path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(endpoint_path, None)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
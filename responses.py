@@ -0,0 +1,92 @@
+import asyncio
+import base64
+import json
+import uuid
+from aiohttp import web
+
+from .images import EncodedImage, collect_images, encode_all, image_pool, replace_images, sniff_content_type
+
+RESPONSE_FORMATS = ["json", "multipart", "stream"]
+
+def negotiate_format(request):
+    """
+    Picks the response format from ?format= or, failing that, the Accept header.
+    json - Images are base64 encoded strings within the JSON result.
+    multipart - A multipart/mixed response with the JSON result first and one part per image.
+    stream - Same as multipart, but chunked, with each image written as soon as it is encoded.
+    """
+    format = request.rel_url.query.get("format")
+    if format in RESPONSE_FORMATS:
+        return format
+    if "multipart/mixed" in request.headers.get("Accept", ""):
+        return "multipart"
+    return "json"
+
+def image_reference(index):
+    return "cid:image-{}".format(index)
+
+def part_header(boundary, content_type, content_id=None):
+    header = "--{}\r\nContent-Type: {}\r\n".format(boundary, content_type)
+    if content_id is not None:
+        header += "Content-ID: <{}>\r\n".format(content_id)
+    return (header + "\r\n").encode("utf-8")
+
+def with_references(result, images):
+    # The JSON part refers to each image part by its Content-ID
+    index = {id(image): i for i, image in enumerate(images)}
+    return replace_images(result, lambda image: image_reference(index[id(image)]))
+
+def sse_event(event, data):
+    if event is None:
+        # A comment, which clients ignore, to keep proxies from closing an idle connection
+        return b": keep-alive\n\n"
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data)).encode("utf-8")
+
+async def return_png_response(result, headers):
+    image = result["RETURN_PNG"][0]
+    if isinstance(image, EncodedImage):
+        image_bytes = (await encode_all([image]))[0]
+    else:
+        image_bytes = base64.b64decode(image)
+    return web.Response(body=image_bytes, content_type=sniff_content_type(image_bytes), headers=headers)
+
+async def json_response(result, headers):
+    await encode_all(collect_images(result))
+    return web.json_response(replace_images(result, EncodedImage.to_base64), headers=headers)
+
+async def multipart_response(result, headers):
+    images = collect_images(result)
+    encoded = await encode_all(images)
+    boundary = uuid.uuid4().hex
+    body = [part_header(boundary, "application/json"), json.dumps(with_references(result, images)).encode("utf-8"), b"\r\n"]
+    for i, image in enumerate(images):
+        body += [part_header(boundary, image.content_type, "image-{}".format(i)), encoded[i], b"\r\n"]
+    body.append("--{}--\r\n".format(boundary).encode("utf-8"))
+    return web.Response(body=b"".join(body), headers=dict(headers, **{ "Content-Type": "multipart/mixed; boundary=" + boundary }))
+
+async def stream_response(request, result, headers):
+    images = collect_images(result)
+    # Start encoding everything up front, then write each image as soon as it's ready
+    loop = asyncio.get_running_loop()
+    pending = [loop.run_in_executor(image_pool, image.encode) for image in images]
+    boundary = uuid.uuid4().hex
+    response = web.StreamResponse(headers=dict(headers, **{ "Content-Type": "multipart/mixed; boundary=" + boundary }))
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    await response.write(part_header(boundary, "application/json") + json.dumps(with_references(result, images)).encode("utf-8") + b"\r\n")
+    for i, image in enumerate(images):
+        data = await pending[i]
+        await response.write(part_header(boundary, image.content_type, "image-{}".format(i)) + data + b"\r\n")
+    await response.write("--{}--\r\n".format(boundary).encode("utf-8"))
+    await response.write_eof()
+    return response
+
+async def result_response(request, result, headers={}):
+    if len(result) == 1 and "RETURN_PNG" in result:
+        return await return_png_response(result, headers)
+    format = negotiate_format(request)
+    if format == "multipart":
+        return await multipart_response(result, headers)
+    elif format == "stream":
+        return await stream_response(request, result, headers)
+    return await json_response(result, headers)
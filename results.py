@@ -0,0 +1,53 @@
+import asyncio
+import threading
+
+class ResultStore:
+    """
+    Hands API Output results from the executor thread to the request waiting on them, keyed by
+    prompt id, so they don't have to be read back out of ComfyUI's history.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.waiters = {}
+
+    def expect(self, key):
+        with self.lock:
+            self.pending[key] = []
+
+    def ready(self, key, count):
+        """
+        Returns a future that's done once count outputs have been published for key, so the
+        request can have its results without waiting for the rest of the prompt to finish.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if len(self.pending.get(key, [])) >= count:
+                future.set_result(None)
+            else:
+                self.waiters[key] = (count, future, loop)
+        return future
+
+    def publish(self, key, output):
+        with self.lock:
+            outputs = self.pending.get(key)
+            if outputs is None:
+                return False
+            outputs.append(output)
+            waiter = self.waiters.get(key)
+            if waiter is not None and len(outputs) >= waiter[0]:
+                del self.waiters[key]
+                waiter[2].call_soon_threadsafe(set_ready, waiter[1])
+            return True
+
+    def collect(self, key):
+        with self.lock:
+            self.waiters.pop(key, None)
+            return self.pending.pop(key, None)
+
+def set_ready(future):
+    if not future.done():
+        future.set_result(None)
+
+api_results = ResultStore()
@@ -0,0 +1,36 @@
+import threading
+import uuid
+
+UPLOAD_PREFIX = "apitools-upload:"
+
+class UploadStore:
+    """
+    Holds raw files uploaded with multipart requests. The request body only carries a short token
+    for each file, so prompts stay small and JSON serializable and images never go through base64.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs = {}
+
+    def put(self, data):
+        token = UPLOAD_PREFIX + str(uuid.uuid4())
+        with self.lock:
+            self.blobs[token] = data
+        return token
+
+    def get(self, token):
+        with self.lock:
+            data = self.blobs.get(token)
+        if data is None:
+            raise ValueError("Upload {} is no longer available".format(token))
+        return data
+
+    def release(self, tokens):
+        with self.lock:
+            for token in tokens:
+                self.blobs.pop(token, None)
+
+def is_upload(value):
+    return isinstance(value, str) and value.startswith(UPLOAD_PREFIX)
+
+upload_store = UploadStore()